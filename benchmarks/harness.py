@@ -0,0 +1,55 @@
+"""Loads the extension outside the webui, for the scripts in this folder.
+
+scripts/main.py imports the webui's `modules` package and registers its callbacks when
+it's imported, so stand-ins for those are installed first. Every cache goes to a fresh
+temporary folder, so a run never reads or fills the cache of a real install.
+"""
+import importlib.util
+import os
+import sys
+import tempfile
+import types
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def load_extension(**environment):
+    """Import scripts/main.py on its own and return the module.
+
+    Args:
+        environment: Environment variables the extension reads at import, such as
+            BOORU2PROMPT_FIXTURES. They're set before the import.
+
+    Returns:
+        module: The extension, with its caches in a new temporary folder
+    """
+    os.environ.update(environment)
+    os.environ["BOORU2PROMPT_CACHE_DIR"] = tempfile.mkdtemp(prefix="booru2prompt-cache-")
+    _install_webui_stand_ins()
+
+    spec = importlib.util.spec_from_file_location("booru2prompt_main", os.path.join(ROOT, "scripts", "main.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def _install_webui_stand_ins():
+    if "modules" in sys.modules:
+        return
+
+    def ignore(*args, **kwargs):
+        return None
+
+    package = types.ModuleType("modules")
+    package.__path__ = []
+    submodules = {
+        "ui": {},
+        "scripts": {},
+        "script_callbacks": {"on_ui_tabs": ignore, "on_app_started": ignore},
+        "shared": {"cmd_opts": types.SimpleNamespace(api=False, nowebui=False, api_auth=None)},
+        "infotext_utils": {"create_buttons": lambda names: {}, "bind_buttons": ignore},
+    }
+    sys.modules["modules"] = package
+    for name, attributes in submodules.items():
+        submodule = types.ModuleType(f"modules.{name}")
+        submodule.__dict__.update(attributes)
+        setattr(package, name, submodule)
+        sys.modules[f"modules.{name}"] = submodule
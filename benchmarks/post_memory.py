@@ -0,0 +1,62 @@
+"""Compare the memory held by cached posts as plain dicts and as the extension's _PostRecords.
+
+    python benchmarks/post_memory.py [--posts 100000]
+
+Tags are drawn from a realistic vocabulary, so repeated tags show what interning saves.
+Runs in its own process, so the tag table it fills is never the one a webui is using.
+"""
+import argparse
+import tracemalloc
+
+from harness import load_extension
+
+def sample_post(vocabulary, index):
+    general = " ".join(vocabulary[(index * 7 + offset * 131) % len(vocabulary)] for offset in range(30))
+    return {
+        "id": index,
+        "tag_string_general": general,
+        "tag_string_artist": vocabulary[index % 500],
+        "tag_string_character": vocabulary[index % 3000],
+        "tag_string_copyright": vocabulary[index % 200],
+        "tag_string_meta": "highres absurdres",
+        "large_file_url": f"https://example.com/sample/{index:08d}.jpg",
+    }
+
+def measure(build, posts):
+    tracemalloc.start()
+    kept = [build(post) for post in posts]
+    used, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del kept
+    return used
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--posts", type=int, default=100000, help="how many posts to build")
+    args = parser.parse_args()
+
+    extension = load_extension()
+    vocabulary = [f"tag_{index}_{'x' * (index % 12)}" for index in range(20000)]
+    posts = [sample_post(vocabulary, index) for index in range(args.posts)]
+
+    def as_dict(post):
+        #The shape posts had before records: fresh strings for every tag of every post
+        return {
+            "general": extension._normalize_tags(post["tag_string_general"]),
+            "artist": extension._normalize_tags(post["tag_string_artist"]),
+            "character": extension._normalize_tags(post["tag_string_character"]),
+            "copyright": extension._normalize_tags(post["tag_string_copyright"]),
+            "meta": extension._normalize_tags(post["tag_string_meta"]),
+            "image_url": post["large_file_url"],
+        }
+
+    dict_bytes = measure(as_dict, posts)
+    #The tag table is still empty here, so its own cost is counted with the records
+    record_bytes = measure(extension._normalize_danbooru_post, posts)
+    print(f"posts: {args.posts}")
+    print(f"dict bytes: {dict_bytes}")
+    print(f"record bytes: {record_bytes}")
+    print(f"ratio: {dict_bytes / record_bytes if record_bytes else float('inf'):.2f}")
+
+if __name__ == "__main__":
+    main()
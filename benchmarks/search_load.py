@@ -0,0 +1,75 @@
+"""Send a burst of searches and tag grabs through the extension and report throughput and latency.
+
+    python benchmarks/search_load.py "some tags" --record    # once, against the booru
+    python benchmarks/search_load.py "some tags"             # from then on, from the recording
+
+Searches cycle through the first five pages of the query, and grabs select posts from
+its first page. Replays never touch the network, so the numbers measure the extension
+rather than the booru. Posts and images are fetched every time rather than answered from
+the extension's caches, unless --warm is given, so a run measures parsing and downloading
+and not just cache hits. The booru is the active one in settings.json.
+"""
+import argparse
+import asyncio
+import time
+
+import numpy as np
+
+from harness import load_extension
+
+async def send_load(extension, query, booru_name, requests, concurrency):
+    first_page, _ = await extension.searchbooru(query, False, 1, booru_name)
+    references = [reference for _, reference in first_page]
+    #Page through once in order, so every run asks for pages by the same cursors and a recording covers a replay
+    for page in range(2, 6):
+        await extension.gotopage(query, False, page, booru_name)
+    limiter = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def send(index):
+        async with limiter:
+            started = time.perf_counter()
+            if index % 2 and references:
+                await extension.grabtags(references[index % len(references)], "", True, False, True, True, True, False, booru_name)
+            else:
+                await extension.gotopage(query, False, 1 + index % 5, booru_name)
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(send(index) for index in range(requests)))
+    return time.perf_counter() - started, latencies
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("query", help="the tags to search for")
+    parser.add_argument("--booru", help="the booru to use by name, instead of the active one")
+    parser.add_argument("--requests", type=int, default=200, help="how many searches and grabs to send")
+    parser.add_argument("--concurrency", type=int, default=16, help="how many to have in flight at once")
+    parser.add_argument("--record", action="store_true", help="fetch from the booru and record every response")
+    parser.add_argument("--fixtures", help="the folder recordings are kept in, instead of the extension's fixtures folder")
+    parser.add_argument("--timing", action="store_true", help="make each replayed response take as long as it did when recorded")
+    parser.add_argument("--warm", action="store_true", help="answer repeated posts and images from the extension's caches")
+    args = parser.parse_args()
+
+    environment = {"BOORU2PROMPT_FIXTURES": "record" if args.record else "replay"}
+    if args.fixtures:
+        environment["BOORU2PROMPT_FIXTURE_DIR"] = args.fixtures
+    if args.timing:
+        environment["BOORU2PROMPT_REPLAY_TIMING"] = "1"
+    extension = load_extension(**environment)
+    if not args.warm:
+        #Recording with the caches off too means a replay only ever asks for responses that were recorded
+        async def never_cached(host, post_id):
+            return None
+
+        extension._cached_post = never_cached
+        extension._image_store_key = lambda md5, original: None
+
+    elapsed, latencies = asyncio.run(send_load(extension, args.query, args.booru, args.requests, args.concurrency))
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+    print(f"requests: {args.requests} at concurrency {args.concurrency}")
+    print(f"requests per second: {args.requests / elapsed:.1f}")
+    print(f"latency p50 {p50 * 1000:.1f} ms, p95 {p95 * 1000:.1f} ms, p99 {p99 * 1000:.1f} ms")
+
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,44 @@
+import asyncio
+import atexit
 import base64
+import contextvars
+import copy
+import cProfile
+import functools
+import hashlib
+import hmac
 import json
+import math
 import os
 import re
+import secrets
 import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from array import array
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from functools import lru_cache
-from urllib.request import urlopen, Request
+from types import MappingProxyType
+from typing import List, Optional
 from urllib import parse
-from urllib.error import HTTPError, URLError
 import inspect
 
 import gradio as gr
+import httpx
+import numpy as np
+from fastapi import Depends, HTTPException
+from fastapi.responses import StreamingResponse
+from fastapi.security import HTTPBasic, HTTPBasicCredentials
+from PIL import Image
+from pydantic import BaseModel, Field
 
 import modules.ui
-from modules import script_callbacks, scripts
+from modules import script_callbacks, scripts, shared
 
 #The auto1111 guide on developing extensions says to use scripts.basedir() to get the current directory
 #However, for some reason, this kept returning the stable diffusion root instead.
@@ -36,6 +62,153 @@ SYSTEM_DISPLAY_NAMES = {
 SUPPORTED_SYSTEMS = tuple(SYSTEM_DISPLAY_NAMES.keys())
 SYSTEM_NAME_LOOKUP = {v: k for k, v in SYSTEM_DISPLAY_NAMES.items()}
 
+#How many images may be downloading at once across every user of the extension
+MAX_CONCURRENT_DOWNLOADS = 16
+
+#Each request writes its images into its own folder under tempimages; folders older than this are swept
+REQUEST_DIR_MAX_AGE = 60 * 60
+#How often old request folders are swept, at most, in seconds
+REQUEST_DIR_PRUNE_INTERVAL = 10 * 60
+
+SETTINGS_PATH = edirectory + "settings.json"
+#Saves within this many seconds of each other are written to disk once
+SETTINGS_PERSIST_DELAY = 0.5
+#How often readers check settings.json for edits made outside the extension
+SETTINGS_RELOAD_INTERVAL = 1.0
+
+#Where every cache lives. Webui installs pointed at the same folder share one cache, whichever machine they run on
+CACHE_DIR = os.environ.get("BOORU2PROMPT_CACHE_DIR") or os.path.join(edirectory, "cache")
+#Detected booru types, tag categories, image hashes and posts, in one SQLite database any number of processes can use at once
+CACHE_DB_PATH = os.path.join(CACHE_DIR, "booru2prompt.sqlite3")
+#SQLite's journal mode for the cache database. The default rollback journal works wherever the folder lives,
+#network filesystems included. Set BOORU2PROMPT_CACHE_JOURNAL=wal to let reads carry on during a write, but only
+#when every process using the cache runs on the machine the folder is on
+CACHE_JOURNAL_MODE = os.environ.get("BOORU2PROMPT_CACHE_JOURNAL", "delete")
+#How long a lookup waits for another process to finish writing to the cache database before treating it as a miss, in seconds
+CACHE_DB_READ_TIMEOUT = 0.5
+#How long a queued write waits for its turn, in seconds. Nothing waits on writes, so they can afford to be patient
+CACHE_DB_WRITE_TIMEOUT = 60.0
+
+#Every image downloaded is kept here under its md5, so the same file is never downloaded twice
+IMAGE_STORE_DIR = os.path.join(CACHE_DIR, "images")
+#The image store is pruned back under this many bytes, dropping the least recently used images first
+IMAGE_STORE_MAX_BYTES = 4 * 1024 ** 3
+#Stored images nobody has used for this long are dropped, in seconds
+IMAGE_STORE_MAX_AGE = 30 * 24 * 60 * 60
+#How often a process prunes the image store, at most, in seconds
+IMAGE_STORE_PRUNE_INTERVAL = 10 * 60
+
+#How many of the 64 perceptual hash bits may differ for two images to count as the same picture
+MAX_IMAGE_HASH_DISTANCE = 10
+
+#Tag categories every normalized post carries, in the order they're stored
+POST_TAG_CATEGORIES = ("general", "artist", "character", "copyright", "meta")
+
+#How long a detected booru type is trusted before the booru is probed again, in seconds
+BOORU_TYPE_CACHE_MAX_AGE = 7 * 24 * 60 * 60
+#How long responses fetched by the startup prefetch wait to be used by the first matching search, in seconds
+PRIMED_RESPONSE_TTL = 10 * 60
+#How long an idle connection is kept open for reuse, long enough for startup warm-up to pay off
+KEEPALIVE_EXPIRY = 120.0
+
+#Statuses that mean a host is overloaded or rate limiting, so one of its mirrors should be tried
+FAILOVER_STATUS_CODES = (408, 429)
+#How much each new request moves a host's smoothed latency and error rate
+HOST_HEALTH_SMOOTHING = 0.3
+#The latency assumed for a host that hasn't answered yet, in seconds
+UNMEASURED_HOST_LATENCY = 0.5
+#How many failures in a row take a host out of rotation, and for how many seconds
+CIRCUIT_BREAKER_FAILURES = 3
+CIRCUIT_BREAKER_COOLDOWN = 30.0
+
+#How many tag names to send in one Gelbooru tag lookup
+TAG_LOOKUP_BATCH_SIZE = 100
+#How many tags to ask the cache database about in one query, well under SQLite's limit on query parameters
+TAG_TYPE_QUERY_BATCH_SIZE = 500
+#How many single-tag Moebooru lookups may run at once
+MAX_CONCURRENT_TAG_LOOKUPS = 8
+#Numeric tag types from each API, mapped onto POST_TAG_CATEGORIES
+MOEBOORU_TAG_TYPES = {0: "general", 1: "artist", 3: "copyright", 4: "character", 5: "artist", 6: "meta"}
+GELBOORU_TAG_TYPES = {0: "general", 1: "artist", 3: "copyright", 4: "character", 5: "meta", 6: "general"}
+#Moebooru's include_tags=1 names the types instead of numbering them
+MOEBOORU_TAG_TYPE_NAMES = {
+    "general": "general",
+    "artist": "artist",
+    "copyright": "copyright",
+    "character": "character",
+    "circle": "artist",
+    "faults": "meta",
+}
+#How many normalized posts to keep around so reselecting a searched post doesn't refetch it
+POST_CACHE_SIZE = 50000
+#How long a post in the cache database is used before it's fetched again, in case its tags were edited, in seconds
+POST_CACHE_MAX_AGE = 24 * 60 * 60
+
+#How many posts a page shows in the search gallery
+SEARCH_PAGE_SIZE = 6
+#Streams search images that need the booru's credentials to the browser, since it can't send them itself
+IMAGE_PROXY_PATH = "/booru2prompt/image"
+#How long the browser may reuse an image from the proxy, in seconds
+IMAGE_PROXY_MAX_AGE = 60 * 60
+#How many distinct queries keep their page cursors around
+PAGE_CURSOR_QUERIES = 1000
+#How often a running export reports its progress to the UI, in seconds
+EXPORT_PROGRESS_INTERVAL = 1.0
+#How often a running consensus prompt shows its progress, in seconds
+CONSENSUS_PROGRESS_INTERVAL = 0.5
+#Lists every post an export has finished, so an interrupted export can pick up where it left off
+EXPORT_MANIFEST_NAME = "booru2prompt_manifest.jsonl"
+#How many posts the first refresh of a saved search reads, before it has a newest post to start from
+WATCH_FIRST_REFRESH_POSTS = 20
+#The most new posts one refresh of a saved search reads, so a busy query can't turn into an export
+MAX_WATCH_POSTS = 1000
+#How many rows the Watch tab's feed keeps, newest first
+WATCH_FEED_ROWS = 500
+#Boorus whose ("after", id) cursor returns the posts just above id. The rest return the newest posts above it
+AFTER_CURSOR_ASCENDS = {"danbooru", "e621"}
+
+#When results are being filtered, fetch this many times a page's worth at once so pages stay full
+FILTER_OVERFETCH_FACTOR = 3
+#File extensions that can only be animations, hidden along with the "animated" tag
+ANIMATED_EXTENSIONS = ("gif", "mp4", "webm", "zip", "swf", "apng")
+#Philomena only marks a post's rating with one of these tags
+PHILOMENA_RATINGS = {"safe": "g", "suggestive": "s", "questionable": "q", "explicit": "e"}
+
+#The largest page each API will return, used when skipping ahead to a far page
+MAX_PAGE_SIZES = {
+    "danbooru": 200,
+    "e621": 320,
+    "moebooru": 100,
+    "gelbooru": 100,
+    "philomena": 50,
+}
+
+#Comma separated profiling modes, read once at startup:
+#  trace   - write a Chrome trace (chrome://tracing or ui.perfetto.dev) of each search, post grab, detection and export
+#  sample  - also write the sampled stacks of the network thread during each of those, in flamegraph's folded format
+#  cprofile - also keep a cProfile of the network thread, rewritten to network-<pid>.prof after each of those
+PROFILE_MODES = frozenset(mode.strip() for mode in os.environ.get("BOORU2PROMPT_PROFILE", "").lower().split(",") if mode.strip())
+PROFILES_DIR = os.path.join(edirectory, "profiles")
+#How often the sampling profiler looks at the network thread, in seconds
+PROFILE_SAMPLE_INTERVAL = 0.005
+
+#Record or replay booru traffic, read once at startup:
+#  record - save every response into the fixture folder as it's fetched
+#  replay - answer every request from the fixture folder, without touching the network
+FIXTURE_MODE = os.environ.get("BOORU2PROMPT_FIXTURES", "").strip().lower()
+FIXTURES_DIR = os.environ.get("BOORU2PROMPT_FIXTURE_DIR") or os.path.join(edirectory, "fixtures")
+#Set to 1 to make each replayed response take as long as it did when it was recorded
+FIXTURE_REPLAY_TIMING = os.environ.get("BOORU2PROMPT_REPLAY_TIMING", "") == "1"
+#The only response headers kept in a fixture; cookies and everything else are dropped
+FIXTURE_HEADERS = ("content-type", "location")
+
+#All booru traffic runs on one dedicated event loop with one pooled client, so a single
+#thread can serve every in-flight request no matter which Gradio worker started it.
+_network_loop = None
+_network_loop_lock = threading.Lock()
+_http_client = None
+_download_semaphore = asyncio.Semaphore(MAX_CONCURRENT_DOWNLOADS)
+
 def loadsettings():
     """Return a dictionary of settings read from settings.json in the extension directory
 
@@ -43,9 +216,12 @@ def loadsettings():
         dict: settings and api keys
     """    
     print("Loading booru2prompt settings")
-    with open(edirectory + "settings.json", encoding="utf-8") as file:
+    with open(SETTINGS_PATH, encoding="utf-8") as file:
         settings = json.load(file)
 
+    return _normalize_settings(settings)
+
+def _normalize_settings(settings):
     if "boorus" not in settings:
         settings["boorus"] = []
 
@@ -54,35 +230,119 @@ def loadsettings():
         booru.setdefault("apikey", "")
         booru.setdefault("cookie", "")
         booru.setdefault("system", "auto")
+        #Other hosts serving the same API, used when the main one is slow or down
+        booru.setdefault("mirrors", [])
         if booru["system"] not in SUPPORTED_SYSTEMS:
             booru["system"] = "auto"
 
     if settings.get("boorus") and settings.get("active") not in [b["name"] for b in settings["boorus"]]:
         settings["active"] = settings["boorus"][0]["name"]
+    elif not settings.get("boorus"):
+        settings["active"] = ""
+
+    settings.setdefault("negativeprompt", "")
+    #Connect to every booru and detect its type in the background when the UI loads
+    settings.setdefault("warmup", True)
+    #A search to run on the active booru at startup, so its first page is ready before it's asked for
+    settings.setdefault("warmupquery", "")
+    #The Watch tab's searches, each with the newest post id it has already shown
+    settings.setdefault("savedsearches", [])
 
     return settings
 
-def _booru_names():
-    return [booru["name"] for booru in settings["boorus"]]
+class _SettingsSnapshot:
+    """One immutable version of settings.json.
+
+    Snapshots are never modified once built. Writers publish a new snapshot instead,
+    so readers can keep using whichever one they grabbed without taking a lock.
+    """
+
+    __slots__ = ("active", "negativeprompt", "boorus", "by_name", "_raw")
+
+    def __init__(self, raw):
+        self._raw = raw
+        self.active = raw.get("active", "")
+        self.negativeprompt = raw.get("negativeprompt", "")
+        self.boorus = tuple(MappingProxyType(booru) for booru in raw["boorus"])
+        self.by_name = MappingProxyType({booru["name"]: booru for booru in self.boorus})
+
+    def get(self, key, default=None):
+        """Read a top-level setting. The returned value must be treated as read-only."""
+        return self._raw.get(key, default)
+
+    def to_dict(self):
+        """Return a private, mutable copy of the settings."""
+        return copy.deepcopy(self._raw)
+
+_settings_lock = threading.RLock()
+_settings_snapshot = None
+_settings_file_mtime = None
+_settings_checked_at = 0.0
+_settings_persist_timer = None
+
+def _current_settings():
+    """Return the current settings snapshot, picking up edits made to settings.json on disk."""
+    global _settings_checked_at
+    now = time.monotonic()
+    if now - _settings_checked_at >= SETTINGS_RELOAD_INTERVAL:
+        _settings_checked_at = now
+        _reload_settings_if_changed()
+    return _settings_snapshot
+
+def _reload_settings_if_changed():
+    global _settings_snapshot, _settings_file_mtime
+    try:
+        mtime = os.stat(SETTINGS_PATH).st_mtime_ns
+    except OSError:
+        return
+    if mtime == _settings_file_mtime:
+        return
+
+    with _settings_lock:
+        #A save that hasn't reached the disk yet is newer than whatever is there
+        if _settings_persist_timer is not None or mtime == _settings_file_mtime:
+            return
+        try:
+            raw = loadsettings()
+        except (OSError, ValueError) as error:
+            print(f"Ignoring unreadable booru2prompt settings: {error}")
+            _settings_file_mtime = mtime
+            return
+        _settings_snapshot = _SettingsSnapshot(raw)
+        _settings_file_mtime = mtime
+
+def _update_settings(mutate):
+    """Apply mutate to a private copy of the settings and publish the result.
 
-def _find_booru_index(name):
-    for index, booru in enumerate(settings["boorus"]):
+    Args:
+        mutate (callable): Receives the settings as a plain dict and edits it in place.
+            Raising leaves the published settings untouched.
+
+    Returns:
+        Whatever mutate returned
+    """
+    global _settings_snapshot
+    with _settings_lock:
+        raw = _settings_snapshot.to_dict()
+        result = mutate(raw)
+        _settings_snapshot = _SettingsSnapshot(_normalize_settings(raw))
+        _schedule_settings_persist()
+    return result
+
+def _find_booru_index(boorus, name):
+    for index, booru in enumerate(boorus):
         if booru["name"] == name:
             return index
     return None
 
 def _ensure_active(preferred=None):
-    booru_names = _booru_names()
-    if not booru_names:
-        settings["active"] = ""
-        return ""
-
-    if preferred and preferred in booru_names:
-        settings["active"] = preferred
-    elif settings.get("active") not in booru_names:
-        settings["active"] = booru_names[0]
-
-    return settings["active"]
+    snapshot = _current_settings()
+    if preferred and preferred in snapshot.by_name and preferred != snapshot.active:
+        def select(raw):
+            raw["active"] = preferred
+        _update_settings(select)
+        return preferred
+    return snapshot.active
 
 def _normalize_host(host):
     host = (host or "").strip()
@@ -106,13 +366,69 @@ def _normalize_host(host):
 
     return normalized_host
 
+def _normalize_hosts(hosts):
+    """Normalize a comma or space separated list of hosts, the first being the booru's main host."""
+    normalized = []
+    for host in re.split(r"[\s,]+", (hosts or "").strip()):
+        if host:
+            host = _normalize_host(host)
+            if host not in normalized:
+                normalized.append(host)
+    if not normalized:
+        raise gr.Error("Host URL cannot be empty.")
+    return normalized
+
+def _booru_hosts(booru):
+    return (booru.get("host", ""), *booru.get("mirrors", ()))
+
+def _format_hosts(booru):
+    return ", ".join(host for host in _booru_hosts(booru) if host)
+
+def _schedule_settings_persist():
+    global _settings_persist_timer
+    with _settings_lock:
+        if _settings_persist_timer is not None:
+            _settings_persist_timer.cancel()
+        timer = threading.Timer(SETTINGS_PERSIST_DELAY, _persist_settings)
+        timer.daemon = True
+        _settings_persist_timer = timer
+        timer.start()
+
 def _persist_settings():
-    with open(edirectory + "settings.json", "w", encoding="utf-8") as file:
-        json.dump(settings, file, indent=4)
+    """Write the current snapshot to settings.json, replacing the old file in one step."""
+    global _settings_persist_timer, _settings_file_mtime
+    with _settings_lock:
+        if _settings_persist_timer is threading.current_thread():
+            _settings_persist_timer = None
+
+        fd, temp_path = tempfile.mkstemp(prefix=".settings-", suffix=".json", dir=os.path.dirname(SETTINGS_PATH))
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as file:
+                json.dump(_settings_snapshot.to_dict(), file, indent=4)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(temp_path, SETTINGS_PATH)
+        except BaseException:
+            try:
+                os.unlink(temp_path)
+            except OSError:
+                pass
+            raise
+        _settings_file_mtime = os.stat(SETTINGS_PATH).st_mtime_ns
+
+def _flush_settings():
+    global _settings_persist_timer
+    with _settings_lock:
+        if _settings_persist_timer is None:
+            return
+        _settings_persist_timer.cancel()
+        _settings_persist_timer = None
+        _persist_settings()
 
 def _build_settings_outputs():
-    active_name = _ensure_active()
-    booru_names = _booru_names()
+    snapshot = _current_settings()
+    active_name = snapshot.active
+    booru_names = [booru["name"] for booru in snapshot.boorus]
 
     if not booru_names:
         return (
@@ -127,7 +443,7 @@ def _build_settings_outputs():
             "",
         )
 
-    booru = next((b for b in settings["boorus"] if b["name"] == active_name), None)
+    booru = snapshot.by_name.get(active_name)
     if booru is None:
         raise gr.Error(f"Booru '{active_name}' was not found.")
 
@@ -137,7 +453,7 @@ def _build_settings_outputs():
     return (
         gr.Dropdown.update(choices=booru_names, value=active_name),
         booru.get("name", ""),
-        booru.get("host", ""),
+        _format_hosts(booru),
         booru.get("username", ""),
         booru.get("apikey", ""),
         booru.get("cookie", ""),
@@ -146,7 +462,8 @@ def _build_settings_outputs():
         active_name,
     )
 
-def _sanitize_url_for_logging(url):
+def _sanitize_url(url):
+    """Return url with any credentials in its query string masked out."""
     parsed = parse.urlparse(url)
     query_items = parse.parse_qsl(parsed.query, keep_blank_values=True)
     redacted = []
@@ -157,7 +474,10 @@ def _sanitize_url_for_logging(url):
             redacted.append((key, value))
 
     sanitized = parsed._replace(query=parse.urlencode(redacted))
-    print(parse.urlunparse(sanitized))
+    return parse.urlunparse(sanitized)
+
+def _sanitize_url_for_logging(url):
+    print(_sanitize_url(url))
 
 def _append_query(url, params):
     if not params:
@@ -194,48 +514,502 @@ def _build_request_headers(username="", apikey="", cookie="", *, auth_mode="danb
     return headers
 
 
-def _fetch_json(url, *, headers=None, raise_for_status=True):
-    merged_headers = dict(DEFAULT_HEADERS)
-    if headers:
-        merged_headers.update(headers)
-    request = Request(url, data=None, headers=merged_headers)
+def _get_network_loop():
+    """Return the event loop that owns every booru connection, starting it on first use."""
+    global _network_loop
+    with _network_loop_lock:
+        if _network_loop is None:
+            loop = asyncio.new_event_loop()
+            target = loop.run_forever if _network_profiler is None else functools.partial(_run_profiled, loop)
+            thread = threading.Thread(target=target, name="booru2prompt-network", daemon=True)
+            thread.start()
+            _network_loop = loop
+    return _network_loop
+
+async def _run_on_network_loop(coro):
+    """Await a coroutine on the shared network loop from whichever loop the caller is on."""
+    loop = _get_network_loop()
     try:
-        with urlopen(request) as response:
-            payload = response.read()
-    except (HTTPError, URLError) as error:
-        if raise_for_status:
-            raise
-        return None
+        current = asyncio.get_running_loop()
+    except RuntimeError:
+        current = None
+    if current is loop:
+        return await coro
+    return await asyncio.wrap_future(_submit_to_network_loop(coro))
+
+def _submit_to_network_loop(coro):
+    """Schedule a coroutine on the network loop, carrying over the caller's trace if there is one."""
+    trace = _current_trace.get()
+    if trace is not None:
+        coro = _traced(trace, coro)
+    return asyncio.run_coroutine_threadsafe(coro, _get_network_loop())
+
+async def _traced(trace, coro):
+    #Runs as its own task on the network loop, so this only sets the trace for that task and its children
+    _current_trace.set(trace)
+    return await coro
+
+#Profiling. Everything here is a no-op unless BOORU2PROMPT_PROFILE is set.
+
+_current_trace = contextvars.ContextVar("booru2prompt_trace", default=None)
+_network_profiler = cProfile.Profile() if "cprofile" in PROFILE_MODES else None
+_trace_origin = time.perf_counter()
+_trace_counter = 0
+
+class _Trace:
+    """The spans recorded during one profiled call, written out as Chrome trace-event JSON.
+
+    Spans from concurrent tasks overlap, so each asyncio task gets its own row in the trace.
+    """
+
+    __slots__ = ("name", "events", "tasks")
+
+    def __init__(self, name):
+        self.name = name
+        self.events = []
+        self.tasks = {}
+
+    def add(self, name, category, start, end, args):
+        event = {
+            "name": name,
+            "cat": category,
+            "ph": "X",
+            "ts": round((start - _trace_origin) * 1e6, 1),
+            "dur": round((end - start) * 1e6, 1),
+            "pid": os.getpid(),
+            "tid": self._task_row(),
+        }
+        if args:
+            event["args"] = args
+        self.events.append(event)
+
+    def _task_row(self):
+        try:
+            task = asyncio.current_task()
+        except RuntimeError:
+            task = None
+        key = id(task) if task is not None else threading.get_ident()
+        row = self.tasks.get(key)
+        if row is None:
+            row = len(self.tasks) + 1
+            self.tasks[key] = row
+            label = task.get_name() if task is not None else threading.current_thread().name
+            self.events.append({"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": row, "args": {"name": label}})
+        return row
+
+    def write(self, path):
+        with open(path, "w", encoding="utf-8") as file:
+            json.dump({"traceEvents": self.events, "displayTimeUnit": "ms"}, file)
+
+@contextmanager
+def _span(name, category, **args):
+    """Record the time spent inside this block as a span of the current trace, if there is one."""
+    trace = _current_trace.get()
+    if trace is None:
+        yield
+        return
+    if "url" in args:
+        #Traces get attached to bug reports, so keep credentials out of them
+        args["url"] = _sanitize_url(args["url"])
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add(name, category, start, time.perf_counter(), args)
+
+def _profiled(name):
+    """Profile every call of an async function as a trace of its own, or as a span of the trace it's called in.
+
+    Returns the function untouched when profiling is off, so it costs nothing by default.
+    """
+    def decorate(fn):
+        if not PROFILE_MODES:
+            return fn
+
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            if _current_trace.get() is not None:
+                with _span(name, "call"):
+                    return await fn(*args, **kwargs)
+
+            trace = _Trace(name)
+            token = _current_trace.set(trace)
+            sampler = _StackSampler() if "sample" in PROFILE_MODES else None
+            try:
+                with _span(name, "call"):
+                    return await fn(*args, **kwargs)
+            finally:
+                _current_trace.reset(token)
+                if sampler is not None:
+                    sampler.stop()
+                _write_profile(trace, sampler)
+        return wrapper
+    return decorate
+
+def _write_profile(trace, sampler):
+    global _trace_counter
+    _trace_counter += 1
+    base = os.path.join(PROFILES_DIR, f"{trace.name}-{time.strftime('%Y%m%d-%H%M%S')}-{_trace_counter}")
+    try:
+        os.makedirs(PROFILES_DIR, exist_ok=True)
+        trace.write(base + ".trace.json")
+        if sampler is not None:
+            sampler.write(base + ".folded")
+        if _network_profiler is not None:
+            #The profiler has to be paused to dump it, which can only happen on the thread it's watching
+            path = os.path.join(PROFILES_DIR, f"network-{os.getpid()}.prof")
+            _get_network_loop().call_soon_threadsafe(_dump_network_profile, path)
+    except OSError as error:
+        print(f"Failed to write profile {base}: {error}")
+
+def _run_profiled(loop):
+    _network_profiler.enable()
+    loop.run_forever()
+
+def _dump_network_profile(path):
+    _network_profiler.disable()
+    try:
+        _network_profiler.dump_stats(path)
+    except OSError as error:
+        print(f"Failed to write profile {path}: {error}")
+    finally:
+        _network_profiler.enable()
+
+class _StackSampler:
+    """Samples the network thread's stack from a background thread until stopped.
+
+    Any concurrent call running on the network loop shows up in the samples too.
+    """
+
+    def __init__(self):
+        self.counts = Counter()
+        self._stopped = threading.Event()
+        self._target = None
+        self._thread = threading.Thread(target=self._run, name="booru2prompt-sampler", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stopped.wait(PROFILE_SAMPLE_INTERVAL):
+            if self._target is None:
+                self._target = next((thread.ident for thread in threading.enumerate() if thread.name == "booru2prompt-network"), None)
+            frame = sys._current_frames().get(self._target)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                frame = frame.f_back
+            if stack:
+                self.counts[";".join(reversed(stack))] += 1
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def write(self, path):
+        with open(path, "w", encoding="utf-8") as file:
+            for stack, count in self.counts.most_common():
+                file.write(f"{stack} {count}\n")
+
+def _get_http_client():
+    #Only ever called from the network loop, so there's no need to lock here
+    global _http_client
+    if _http_client is None:
+        transport = httpx.AsyncHTTPTransport(
+            limits=httpx.Limits(max_connections=64, max_keepalive_connections=16, keepalive_expiry=KEEPALIVE_EXPIRY),
+        )
+        if FIXTURE_MODE == "record":
+            transport = _FixtureTransport(transport)
+        elif FIXTURE_MODE == "replay":
+            transport = _FixtureTransport(None)
+        _http_client = httpx.AsyncClient(
+            headers=DEFAULT_HEADERS,
+            follow_redirects=True,
+            timeout=httpx.Timeout(30.0, connect=10.0),
+            transport=transport,
+        )
+    return _http_client
+
+class _FixtureTransport(httpx.AsyncBaseTransport):
+    """Records every response into FIXTURES_DIR, or replays them from there in place of the network.
+
+    Sitting under the client means searches, post fetches, downloads and detection are all
+    covered. Fixtures are keyed by method and sanitized URL, so no credentials reach the
+    disk and a replay works whatever credentials are configured. Bodies are stored once
+    per content hash, and kept in memory once replayed so replays can go as fast as the
+    extension does.
+
+    Args:
+        transport (httpx.AsyncBaseTransport): The real transport to record from, or None to replay
+    """
+
+    def __init__(self, transport):
+        self.transport = transport
+        self.fixtures = None
+        self.bodies = {}
+
+    async def handle_async_request(self, request):
+        key = f"{request.method} {_sanitize_url(str(request.url))}"
+        if self.transport is None:
+            return await self._replay(request, key)
+        return await self._record(request, key)
+
+    async def aclose(self):
+        if self.transport is not None:
+            await self.transport.aclose()
+
+    async def _record(self, request, key):
+        started = time.monotonic()
+        response = await self.transport.handle_async_request(request)
+        try:
+            content = await response.aread()
+        finally:
+            await response.aclose()
+        elapsed = time.monotonic() - started
+
+        digest = hashlib.sha256(content).hexdigest()
+        body_path = os.path.join(FIXTURES_DIR, "bodies", digest)
+        if not os.path.exists(body_path):
+            os.makedirs(os.path.dirname(body_path), exist_ok=True)
+            with open(body_path, "wb") as file:
+                file.write(content)
+        headers = {name: response.headers[name] for name in FIXTURE_HEADERS if name in response.headers}
+        with open(os.path.join(FIXTURES_DIR, "index.jsonl"), "a", encoding="utf-8") as file:
+            file.write(json.dumps({"key": key, "status": response.status_code, "headers": headers, "body": digest, "elapsed": round(elapsed, 4)}) + "\n")
+
+        #The body is already decoded, so the headers describing its encoding no longer apply
+        passed_headers = [(name, value) for name, value in response.headers.multi_items() if name.lower() not in ("content-encoding", "content-length", "transfer-encoding")]
+        return httpx.Response(response.status_code, headers=passed_headers, content=content, request=request)
+
+    async def _replay(self, request, key):
+        if self.fixtures is None:
+            self.fixtures = {}
+            index_path = os.path.join(FIXTURES_DIR, "index.jsonl")
+            if os.path.exists(index_path):
+                with open(index_path, encoding="utf-8") as file:
+                    for line in file:
+                        try:
+                            entry = json.loads(line)
+                            #Later recordings of the same request win
+                            self.fixtures[entry["key"]] = entry
+                        except (ValueError, KeyError, TypeError):
+                            continue
+
+        entry = self.fixtures.get(key)
+        if entry is None:
+            raise httpx.ConnectError(f"No recorded response for {key}", request=request)
+        content = self.bodies.get(entry["body"])
+        if content is None:
+            with open(os.path.join(FIXTURES_DIR, "bodies", entry["body"]), "rb") as file:
+                content = file.read()
+            self.bodies[entry["body"]] = content
+        if FIXTURE_REPLAY_TIMING:
+            await asyncio.sleep(entry.get("elapsed", 0))
+        return httpx.Response(entry["status"], headers=entry.get("headers", {}), content=content, request=request)
+
+class _SingleFlight:
+    """Lets concurrent callers asking for the same thing share one call instead of each making their own.
+
+    Only used from the network loop. Results aren't kept once the call finishes; this only
+    merges requests that overlap in time.
+    """
+
+    def __init__(self):
+        self._calls = {}
+
+    async def do(self, key, factory):
+        call = self._calls.get(key)
+        if call is None:
+            call = [asyncio.ensure_future(factory()), 0]
+            self._calls[key] = call
+            call[0].add_done_callback(lambda _, key=key, call=call: self._finish(key, call))
+
+        task = call[0]
+        call[1] += 1
+        try:
+            #Shielded, so one caller giving up doesn't cancel the call for everyone else
+            return await asyncio.shield(task)
+        finally:
+            call[1] -= 1
+            if call[1] == 0 and not task.done():
+                #Forget it straight away, so anyone asking before the cancel lands starts a fresh call
+                self._finish(key, call)
+                task.cancel()
+
+    def _finish(self, key, call):
+        if self._calls.get(key) is call:
+            del self._calls[key]
+
+_request_flights = _SingleFlight()
+_download_flights = _SingleFlight()
+
+def _flight_key(url, headers):
+    #Two requests are only the same if they'd be made with the same credentials
+    credentials = hashlib.sha256(repr((url, sorted((headers or {}).items()))).encode("utf-8")).hexdigest()
+    return _sanitize_url(url), credentials
+
+#Set while the startup prefetch runs, so what it fetches is kept for the search it's standing in for
+_priming = contextvars.ContextVar("booru2prompt_priming", default=False)
+#Responses the startup prefetch fetched, each used once. Only touched from the network loop.
+_primed_responses = {}
+
+async def _fetch_json(url, *, headers=None, raise_for_status=True):
+    key = _flight_key(url, headers)
+    primed = _primed_responses.pop(key, None)
+    if primed is not None and primed[0] > time.monotonic():
+        return primed[1]
 
     try:
-        text = payload.decode("utf-8")
-    except UnicodeDecodeError:
+        payload = await _request_flights.do(key, lambda: _fetch_json_uncoalesced(url, headers))
+    except (httpx.HTTPError, UnicodeDecodeError, json.JSONDecodeError):
         if raise_for_status:
             raise
         return None
 
+    if _priming.get():
+        #A private copy, since whoever asked for it during the prefetch may still be reading it
+        _primed_responses[key] = (time.monotonic() + PRIMED_RESPONSE_TTL, copy.deepcopy(payload))
+    return payload
+
+async def _fetch_json_uncoalesced(url, headers):
+    """Fetch url, failing over to the booru's other hosts while its preferred one is down, overloaded or challenging."""
+    candidates = _failover_urls(url)
+    for attempt, (host, candidate) in enumerate(candidates):
+        started = time.monotonic()
+        try:
+            payload = await _fetch_json_from(candidate, headers)
+        except (httpx.HTTPError, gr.Error, UnicodeDecodeError, json.JSONDecodeError) as error:
+            failed = _is_host_failure(error)
+            if host is not None:
+                _host_health_for(host).record(time.monotonic() - started, failed)
+            if not failed or attempt == len(candidates) - 1:
+                raise
+            reason = f"HTTP {error.response.status_code}" if isinstance(error, httpx.HTTPStatusError) else type(error).__name__
+            print(f"{host} failed ({reason}), trying another host")
+            continue
+        if host is not None:
+            _host_health_for(host).record(time.monotonic() - started, False)
+        return payload
+
+async def _fetch_json_from(url, headers):
+    client = _get_http_client()
+    with _span("fetch", "http", url=url):
+        response = await client.get(url, headers=headers)
+        if response.status_code >= 400 and _is_challenge(response.content):
+            raise _challenge_error()
+        response.raise_for_status()
+
     try:
-        return json.loads(text)
+        with _span("parse", "parse", size=len(response.content)):
+            return json.loads(response.content.decode("utf-8"))
     except json.JSONDecodeError:
-        if "challenge-container" in text and "X-Verification-Challenge" in text:
-            raise gr.Error(
-                "The booru responded with an interactive verification challenge. "
-                "Open the booru in a browser, complete the verification, and paste "
-                "the resulting session cookie into the booru's settings before "
-                "retrying."
-            )
-        if raise_for_status:
-            raise
-        return None
+        if _is_challenge(response.content):
+            raise _challenge_error()
+        raise
+
+def _is_challenge(content):
+    text = content.decode("utf-8", errors="replace")
+    return "challenge-container" in text and "X-Verification-Challenge" in text
+
+def _challenge_error():
+    return gr.Error(
+        "The booru responded with an interactive verification challenge. "
+        "Open the booru in a browser, complete the verification, and paste "
+        "the resulting session cookie into the booru's settings before "
+        "retrying."
+    )
 
+def _is_host_failure(error):
+    """True when error says more about the host than the request, so another host might do better."""
+    if isinstance(error, httpx.TransportError):
+        return True
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code in FAILOVER_STATUS_CODES or error.response.status_code >= 500
+    #Only the verification challenge is raised as a gr.Error this far down
+    return isinstance(error, gr.Error)
 
-def _safe_fetch_json(url, *, description, headers=None):
+class _HostHealth:
+    """Smoothed latency and error rate for one host, plus a circuit breaker.
+
+    After CIRCUIT_BREAKER_FAILURES failures in a row the circuit opens, and the host is
+    only tried once every other host has failed, until CIRCUIT_BREAKER_COOLDOWN passes.
+    """
+
+    __slots__ = ("latency", "error_rate", "failures", "open_until")
+
+    def __init__(self):
+        self.latency = None
+        self.error_rate = 0.0
+        self.failures = 0
+        self.open_until = 0.0
+
+    def record(self, elapsed, failed):
+        if not failed:
+            self.latency = elapsed if self.latency is None else self.latency + HOST_HEALTH_SMOOTHING * (elapsed - self.latency)
+        self.error_rate += HOST_HEALTH_SMOOTHING * ((1.0 if failed else 0.0) - self.error_rate)
+        self.failures = self.failures + 1 if failed else 0
+        if self.failures >= CIRCUIT_BREAKER_FAILURES:
+            self.open_until = time.monotonic() + CIRCUIT_BREAKER_COOLDOWN
+
+    def is_open(self):
+        return self.open_until > time.monotonic()
+
+    def expected_latency(self):
+        """Roughly how long a successful request takes here, counting the failures it takes to get one."""
+        latency = UNMEASURED_HOST_LATENCY if self.latency is None else self.latency
+        return latency / max(1.0 - self.error_rate, 0.1)
+
+#Only touched from the network loop, so neither needs a lock
+_host_health = {}
+_mirror_groups = (None, {})
+
+def _host_health_for(host):
+    health = _host_health.get(host)
+    if health is None:
+        health = _HostHealth()
+        _host_health[host] = health
+    return health
+
+def _mirror_group(url):
+    """Return the host url is on and every host of the same booru, if that booru has mirrors."""
+    global _mirror_groups
+    snapshot = _current_settings()
+    if _mirror_groups[0] is not snapshot:
+        groups = {}
+        for booru in snapshot.boorus:
+            hosts = _booru_hosts(booru)
+            if len(hosts) > 1:
+                for host in hosts:
+                    groups[host] = hosts
+        _mirror_groups = (snapshot, groups)
+
+    for host, hosts in _mirror_groups[1].items():
+        if url == host or url.startswith((host + "/", host + "?")):
+            return host, hosts
+    return None, ()
+
+def _failover_urls(url):
+    """Return (host, url) for every host url could be fetched from, best first.
+
+    Hosts are ranked by their expected latency, with open circuits last and ties
+    going to the order they're configured in.
+    """
+    current, hosts = _mirror_group(url)
+    if current is None:
+        return [(None, url)]
+    ranked = sorted(
+        enumerate(hosts),
+        key=lambda item: (_host_health_for(item[1]).is_open(), _host_health_for(item[1]).expected_latency(), item[0]),
+    )
+    return [(host, host + url[len(current):]) for _, host in ranked]
+
+
+async def _safe_fetch_json(url, *, description, headers=None):
     try:
-        return _fetch_json(url, headers=headers)
-    except HTTPError as error:
-        raise gr.Error(f"Failed to {description}: HTTP {error.code}. The booru may require authentication or the endpoint may not exist.") from error
-    except URLError as error:
-        raise gr.Error(f"Failed to {description}: {error.reason}.") from error
+        return await _fetch_json(url, headers=headers)
+    except httpx.HTTPStatusError as error:
+        raise gr.Error(f"Failed to {description}: HTTP {error.response.status_code}. The booru may require authentication or the endpoint may not exist.") from error
+    except httpx.RequestError as error:
+        raise gr.Error(f"Failed to {description}: {error or error.__class__.__name__}.") from error
     except (UnicodeDecodeError, json.JSONDecodeError) as error:
         raise gr.Error(
             f"Failed to {description}: The booru returned a non-JSON response. "
@@ -288,34 +1062,525 @@ def _normalize_tags(value):
             normalized.append(str(item))
     return [tag for tag in normalized if tag]
 
-def _prepare_local_image_path(index, source_url):
-    parsed = parse.urlparse(source_url)
-    _, ext = os.path.splitext(parsed.path)
-    if not ext or len(ext) > 6:
-        ext = ".jpg"
-    filename = f"temp{index}{ext}"
-    return os.path.join(edirectory, "tempimages", filename)
+def _request_output_dir():
+    """Create a fresh folder for one request's images, so concurrent requests never share files."""
+    temp_root = os.path.join(edirectory, "tempimages")
+    os.makedirs(temp_root, exist_ok=True)
+    _schedule_request_dir_prune(temp_root)
+    return tempfile.mkdtemp(prefix="req-", dir=temp_root)
+
+_request_dirs_pruned_at = None
+_request_dirs_prune_lock = threading.Lock()
+
+def _schedule_request_dir_prune(temp_root):
+    #Sweeping walks and deletes whole folders, so it runs on its own thread now and then, never in a request
+    global _request_dirs_pruned_at
+    with _request_dirs_prune_lock:
+        now = time.monotonic()
+        if _request_dirs_pruned_at is not None and now - _request_dirs_pruned_at < REQUEST_DIR_PRUNE_INTERVAL:
+            return
+        _request_dirs_pruned_at = now
+    threading.Thread(target=_prune_request_dirs, args=(temp_root,), name="booru2prompt request folder prune", daemon=True).start()
+
+def _prune_request_dirs(temp_root):
+    #Gradio copies every image it displays into its own cache, so old request folders are safe to drop
+    cutoff = time.time() - REQUEST_DIR_MAX_AGE
+    for entry in os.scandir(temp_root):
+        if not entry.is_dir() or not entry.name.startswith("req-"):
+            continue
+        try:
+            if entry.stat().st_mtime < cutoff:
+                shutil.rmtree(entry.path, ignore_errors=True)
+        except OSError:
+            continue
 
 
-def _download_to_path(url, destination, *, headers=None):
-    merged_headers = dict(DEFAULT_HEADERS)
-    if headers:
-        merged_headers.update(headers)
+async def _download_to_path(url, destination, *, headers=None):
+    """Stream url into destination.
+
+    Returns:
+        str: The md5 hex digest of the downloaded bytes
+    """
+    client = _get_http_client()
+    digest = hashlib.md5(usedforsecurity=False)
+    async with _download_semaphore:
+        with _span("download", "http", url=url):
+            async with client.stream("GET", url, headers=headers) as response:
+                response.raise_for_status()
+                with open(destination, "wb") as file:
+                    async for chunk in response.aiter_bytes():
+                        digest.update(chunk)
+                        file.write(chunk)
+    return digest.hexdigest()
+
+def _image_store_key(md5, original):
+    if not md5:
+        return None
+    md5 = md5.lower()
+    #Boorus only publish the md5 of the original file, so resized samples get a key of their own
+    return md5 if original else f"{md5}.sample"
+
+def _image_store_path(key):
+    return os.path.join(IMAGE_STORE_DIR, key[:2], key)
+
+def _link_within_store(source, destination):
+    #Only for entries inside the store, which nothing ever edits. Anything handed out is a copy
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copyfile(source, destination)
+
+def _copy_from_store(source, destination):
+    """Copy a stored image to destination, leaving nothing shared that an edit to the copy could change.
+
+    copy_file_range lets filesystems such as Btrfs and XFS clone the file copy-on-write, which costs no
+    extra space. Elsewhere it's an ordinary copy.
+    """
+    with _span("copy", "file", path=destination):
+        if not hasattr(os, "copy_file_range"):
+            shutil.copyfile(source, destination)
+            return
+
+        with open(source, "rb") as reader, open(destination, "wb") as writer:
+            try:
+                remaining = os.fstat(reader.fileno()).st_size
+                while remaining > 0:
+                    copied = os.copy_file_range(reader.fileno(), writer.fileno(), remaining)
+                    if not copied:
+                        break
+                    remaining -= copied
+            except OSError:
+                #Older kernels refuse to copy between filesystems
+                reader.seek(0)
+                writer.seek(0)
+                writer.truncate()
+                shutil.copyfileobj(reader, writer)
+
+def _copy_stored_image(keys, destination):
+    """Copy the first image the store has under keys to destination, returning False if it has none of them."""
+    for key in keys:
+        path = _image_store_path(key)
+        try:
+            _copy_from_store(path, destination)
+            #The store is pruned least recently used first, so a hit counts as a use
+            os.utime(path)
+        except FileNotFoundError:
+            continue
+        return True
+    return False
+
+_image_store_pruned_at = None
+
+def _schedule_image_store_prune():
+    global _image_store_pruned_at
+    now = time.monotonic()
+    if _image_store_pruned_at is not None and now - _image_store_pruned_at < IMAGE_STORE_PRUNE_INTERVAL:
+        return
+    _image_store_pruned_at = now
+    threading.Thread(target=_prune_image_store, name="booru2prompt image store prune", daemon=True).start()
+
+def _prune_image_store():
+    """Drop stored images unused for IMAGE_STORE_MAX_AGE, then the least recently used until the store fits IMAGE_STORE_MAX_BYTES.
+
+    Other processes sharing the store may prune it at the same time, so files that vanish midway are skipped.
+    """
+    now = time.time()
+    entries = []
+    for directory, _, names in os.walk(IMAGE_STORE_DIR):
+        for name in names:
+            path = os.path.join(directory, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            #A download still being written is left alone, unless it was abandoned long ago
+            if name.endswith(".part") and now - stat.st_mtime < IMAGE_STORE_MAX_AGE:
+                continue
+            entries.append((stat.st_mtime, path, (stat.st_dev, stat.st_ino), stat.st_size))
+
+    #A sample's alias shares its file with the digest entry, so each file is counted once
+    sizes = {inode: size for _, _, inode, size in entries}
+    links = Counter(inode for _, _, inode, _ in entries)
+    total = sum(sizes.values())
+    for used, path, inode, _ in sorted(entries):
+        if total <= IMAGE_STORE_MAX_BYTES and now - used <= IMAGE_STORE_MAX_AGE:
+            break
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        except OSError as error:
+            print(f"Could not prune {path} from the booru2prompt image store: {error}")
+            continue
+        links[inode] -= 1
+        if not links[inode]:
+            total -= sizes[inode]
+
+async def _download_image(url, destination, *, headers=None, md5=None, original=False, post=None):
+    """Put a post's image at destination, downloading it only if the image store doesn't have it yet.
+
+    Identical downloads that overlap in time share a single transfer.
+
+    Args:
+        url (str): Where to download the image from
+        destination (str): The path to place the image at
+        headers (dict, optional): Extra request headers, such as auth
+        md5 (str, optional): The md5 the booru reports for the post's original file
+        original (bool, optional): True when url points at the original file rather than a sample
+        post (tuple, optional): The (host, post id) the image belongs to, to add it to the image hash index
+    """
+    keys = [_image_store_key(md5, original)]
+    if not original:
+        #Where a sample was asked for, an original another booru already downloaded serves just as well
+        keys.append(_image_store_key(md5, True))
+    keys = [key for key in keys if key]
+    if not (keys and await asyncio.to_thread(_copy_stored_image, keys, destination)):
+        stored_path = await _download_flights.do(
+            _flight_key(url, headers),
+            lambda: _download_into_store(url, headers, md5, original),
+        )
+        await asyncio.to_thread(_copy_from_store, stored_path, destination)
+
+    if post is not None:
+        await _index_image(post[0], post[1], destination)
+
+async def _download_into_store(url, headers, md5, original):
+    """Download url into the image store and return where it was stored.
 
-    request = Request(url, data=None, headers=merged_headers)
-    with urlopen(request) as response, open(destination, "wb") as file:
-        shutil.copyfileobj(response, file)
+    The store is addressed by the md5 of each file's bytes. Samples also get an entry
+    under the key they'll be looked up by, since the booru only reports the original's md5.
+    """
+    os.makedirs(IMAGE_STORE_DIR, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(suffix=".part", dir=IMAGE_STORE_DIR)
+    os.close(fd)
+    try:
+        digest = await _download_to_path(url, temp_path, headers=headers)
+        if original and md5 and digest != md5.lower():
+            raise ValueError(f"The downloaded file does not match its md5 ({digest}, expected {md5.lower()}).")
+
+        stored_path = _image_store_path(digest)
+        os.makedirs(os.path.dirname(stored_path), exist_ok=True)
+        os.replace(temp_path, stored_path)
+
+        key = _image_store_key(md5, original)
+        if key and key != digest:
+            alias_path = _image_store_path(key)
+            os.makedirs(os.path.dirname(alias_path), exist_ok=True)
+            #Other processes may be reading the store, so the alias appears whole or not at all
+            _link_within_store(stored_path, temp_path)
+            os.replace(temp_path, alias_path)
+        _schedule_image_store_prune()
+        return stored_path
+    finally:
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+
+_CACHE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS booru_types (key TEXT PRIMARY KEY, type TEXT NOT NULL, detected REAL NOT NULL);
+CREATE TABLE IF NOT EXISTS tag_types (host TEXT NOT NULL, tag TEXT NOT NULL, type TEXT NOT NULL, PRIMARY KEY (host, tag)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS image_hashes (host TEXT NOT NULL, post INTEGER NOT NULL, hash INTEGER NOT NULL, PRIMARY KEY (host, post));
+CREATE TABLE IF NOT EXISTS posts (host TEXT NOT NULL, id TEXT NOT NULL, record TEXT NOT NULL, stored REAL NOT NULL, PRIMARY KEY (host, id)) WITHOUT ROWID;
+"""
+
+#SQLite connections can't be shared between threads, so each thread opens its own
+_cache_db_connections = threading.local()
+
+#Lookups and writes each run on their own thread, so the network loop never waits on the disk or another
+#process's lock, and a write waiting its turn never holds up a lookup. One writer per process also means
+#this process's writes never contend with each other
+_cache_db_reader = ThreadPoolExecutor(max_workers=1, thread_name_prefix="booru2prompt cache reader")
+_cache_db_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="booru2prompt cache writer")
+
+def _cache_db(timeout):
+    """Return this thread's connection to the cache database, creating the database if needed."""
+    connection = getattr(_cache_db_connections, "connection", None)
+    if connection is None:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        #Transactions take the write lock up front, so SQLite waits out the timeout for it. Upgrading a
+        #read lock partway through fails at once if another process is waiting to write
+        connection = sqlite3.connect(CACHE_DB_PATH, timeout=timeout, isolation_level="IMMEDIATE")
+        connection.execute(f"PRAGMA journal_mode={CACHE_JOURNAL_MODE}")
+        #Losing the last few writes in a power cut only costs a cache miss
+        connection.execute("PRAGMA synchronous=NORMAL")
+        with connection:
+            connection.executescript(f"BEGIN IMMEDIATE;{_CACHE_SCHEMA}")
+            connection.execute("DELETE FROM posts WHERE stored < ?", (time.time() - POST_CACHE_MAX_AGE,))
+        _cache_db_connections.connection = connection
+    return connection
+
+def _cache_db_failed(error, *, reading=False):
+    #The cache only saves work, so carry on without it rather than failing the request.
+    #A lookup finding another process holding the lock is routine, so that's just a miss
+    if reading and "locked" in str(error):
+        return
+    print(f"The booru2prompt cache database at {CACHE_DB_PATH} is unavailable: {error}")
+
+def _read_with_cache_db(default, function, *args):
+    try:
+        return function(_cache_db(CACHE_DB_READ_TIMEOUT), *args)
+    except sqlite3.Error as error:
+        _cache_db_failed(error, reading=True)
+        return default
+
+def _write_with_cache_db(function, *args):
+    try:
+        function(_cache_db(CACHE_DB_WRITE_TIMEOUT), *args)
+    except sqlite3.Error as error:
+        _cache_db_failed(error)
+
+async def _query_cache_db(default, function, *args):
+    """Run function(connection, *args) on the cache database's reader thread and return what it returns.
 
+    Returns default instead if the database is locked or unavailable.
+    """
+    call = functools.partial(_read_with_cache_db, default, function, *args)
+    return await asyncio.get_running_loop().run_in_executor(_cache_db_reader, call)
+
+def _write_cache_db(function, *args):
+    """Queue function(connection, *args) on the cache database's writer thread, without waiting for it."""
+    _cache_db_writer.submit(_write_with_cache_db, function, *args)
+
+
+class _ImageHashIndex:
+    """The perceptual hashes of one booru's images, held in NumPy arrays so a lookup compares them all at once.
+
+    The hashes live in the cache database, shared by every process. The arrays mirror
+    them and pick up rows other processes added with sync(). A hash added here goes into
+    the arrays at once, and into the database in the background. The arrays grow by
+    doubling, so adding stays cheap. Only touched from the network loop.
+    """
+
+    def __init__(self, host):
+        self.host = host
+        self.size = 0
+        #The last database row mirrored in the arrays
+        self.synced = 0
+        self.hashes = np.zeros(1024, dtype=np.uint64)
+        self.posts = np.zeros(1024, dtype=np.uint64)
+        #Posts added by this process whose rows haven't come back through sync() yet
+        self.pending = set()
+
+    def __contains__(self, post_id):
+        return bool((self.posts[:self.size] == post_id).any())
+
+    async def sync(self):
+        """Pick up the hashes added to the database since the last sync, by this process or any other."""
+        self._apply(await _query_cache_db(None, self._select, self.host, self.synced))
+
+    def add(self, image_hash, post_id):
+        self._append(np.array([image_hash], dtype=np.uint64), np.array([post_id], dtype=np.uint64))
+        self.pending.add(post_id)
+        #SQLite integers are signed, so hashes are stored as the int64 with the same bits
+        _write_cache_db(self._insert, (self.host, post_id, int(np.uint64(image_hash).view(np.int64))))
+
+    @staticmethod
+    def _select(db, host, synced):
+        return db.execute(
+            "SELECT rowid, hash, post FROM image_hashes WHERE rowid > ? AND host = ? ORDER BY rowid",
+            (synced, host),
+        ).fetchall()
+
+    @staticmethod
+    def _insert(db, row):
+        with db:
+            db.execute("INSERT OR IGNORE INTO image_hashes (host, post, hash) VALUES (?, ?, ?)", row)
+
+    def _apply(self, rows):
+        if not rows:
+            return
+        rows = np.array(rows, dtype=np.int64)
+        #Syncs can overlap and read the same rows, so only those past the last one applied are new
+        rows = rows[rows[:, 0] > self.synced]
+        if not len(rows):
+            return
+        self.synced = int(rows[-1, 0])
+        posts = rows[:, 2].view(np.uint64)
+        if self.pending:
+            #Posts this process added are in the arrays already
+            added = np.isin(posts, np.fromiter(self.pending, dtype=np.uint64, count=len(self.pending)))
+            self.pending.difference_update(posts[added].tolist())
+            rows, posts = rows[~added], posts[~added]
+        self._append(rows[:, 1].view(np.uint64), posts)
+
+    def _append(self, hashes, posts):
+        needed = self.size + len(hashes)
+        if needed > len(self.hashes):
+            capacity = max(len(self.hashes) * 2, needed)
+            self.hashes = np.concatenate([self.hashes, np.zeros(capacity - len(self.hashes), dtype=np.uint64)])
+            self.posts = np.concatenate([self.posts, np.zeros(capacity - len(self.posts), dtype=np.uint64)])
+        self.hashes[self.size:needed] = hashes
+        self.posts[self.size:needed] = posts
+        self.size = needed
+
+    async def nearest(self, image_hash, max_distance):
+        """Return (post id, distance) pairs within max_distance bits of image_hash, closest first."""
+        await self.sync()
+        distances = _hamming_distances(self.hashes[:self.size], image_hash)
+        matches = np.flatnonzero(distances <= max_distance)
+        matches = matches[np.argsort(distances[matches], kind="stable")]
+        return [(int(self.posts[index]), int(distances[index])) for index in matches]
+
+_image_hash_indexes = {}
+#How many bits are set in each possible byte, for NumPy versions without bitwise_count
+_BYTE_POPCOUNTS = np.array([bin(value).count("1") for value in range(256)], dtype=np.uint8)
+
+async def _image_hash_index(host):
+    index = _image_hash_indexes.get(host)
+    if index is None:
+        index = _ImageHashIndex(host)
+        _image_hash_indexes[host] = index
+        await index.sync()
+    return index
+
+def _hamming_distances(hashes, image_hash):
+    differences = hashes ^ np.uint64(image_hash)
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(differences)
+    return _BYTE_POPCOUNTS[differences.view(np.uint8)].reshape(-1, 8).sum(axis=1, dtype=np.uint8)
+
+@lru_cache(maxsize=1)
+def _dct_matrix(size):
+    rows = np.arange(size)[:, None]
+    columns = np.arange(size)[None, :]
+    matrix = np.cos(np.pi * (2 * columns + 1) * rows / (2 * size)) * np.sqrt(2 / size)
+    matrix[0] /= np.sqrt(2)
+    return matrix.astype(np.float32)
+
+def _perceptual_hash(path):
+    """Return the 64-bit pHash of the image at path.
+
+    The image is shrunk to 32x32 grayscale, and each bit says whether one of the 8x8
+    lowest frequencies of its DCT is above their median. Resizing, recompression and
+    small edits only flip a few bits.
+    """
+    with Image.open(path) as image:
+        #Lets JPEGs decode at a fraction of their size, which is most of the work for big originals
+        image.draft("L", (64, 64))
+        pixels = np.asarray(image.convert("L").resize((32, 32), Image.LANCZOS), dtype=np.float32)
+    dct = _dct_matrix(32)
+    frequencies = (dct @ pixels @ dct.T)[:8, :8].ravel()
+    bits = frequencies > np.median(frequencies[1:])
+    return int(np.packbits(bits).view(">u8")[0])
+
+async def _index_image(host, post_id, path):
+    """Add a cached post image to its booru's hash index, unless it's already there."""
+    try:
+        post_id = int(post_id)
+    except (TypeError, ValueError):
+        return
+    index = await _image_hash_index(host)
+    if post_id in index:
+        return
+    try:
+        #Decoding the image would hold up every other request on the network loop
+        image_hash = await asyncio.to_thread(_perceptual_hash, path)
+    except (OSError, ValueError, Image.DecompressionBombError):
+        #Videos and other files Pillow can't read just aren't indexed
+        return
+    if post_id not in index:
+        index.add(image_hash, post_id)
+
+async def _find_indexed_post(host, path):
+    try:
+        image_hash = await asyncio.to_thread(_perceptual_hash, path)
+    except (OSError, ValueError, Image.DecompressionBombError):
+        raise gr.Error("That file couldn't be read as an image.")
+    matches = await (await _image_hash_index(host)).nearest(image_hash, MAX_IMAGE_HASH_DISTANCE)
+    return matches[0] if matches else None
+
+
+def _cursor_filter(cursor, *, style):
+    """Turn a (direction, post id) cursor into the id filter a booru's search syntax expects.
+
+    Args:
+        cursor (tuple): ("before", id) for posts older than id, or ("after", id) for newer ones
+        style (str): "page" for Danbooru/e621 page values, "tag" for id:<N tags, "philomena" for id.lt:N
+
+    Returns:
+        str: The page value or search token selecting that side of the cursor
+    """
+    direction, post_id = cursor
+    if style == "page":
+        return f"{'b' if direction == 'before' else 'a'}{post_id}"
+    if style == "philomena":
+        return f"id.{'lt' if direction == 'before' else 'gt'}:{post_id}"
+    return f"id:{'<' if direction == 'before' else '>'}{post_id}"
+
+def _supports_cursor(tags):
+    #Cursors page by post id, which only lines up with the results when they're sorted by id
+    return not any(token.lower().startswith(("order:", "sort:")) for token in (tags or "").split())
+
+def _build_tag_query(query):
+    return (query or "").strip()
+
+class _ResultFilter:
+    """A compiled blacklist that decides which search results never reach the gallery.
+
+    Each rule hides a post when all of its conditions hold: every required tag present,
+    every excluded tag absent, and the extension and rating among the listed ones if any.
+    Tags are compared as ids from _tag_table, so checking a post is a few set operations.
+    """
 
-def _build_tag_query(query, removeanimated):
-    query = (query or "").strip()
+    __slots__ = ("key", "rules")
+
+    def __init__(self, key, rules):
+        self.key = key
+        self.rules = rules
+
+    def rejects(self, record):
+        tag_ids = record.tag_ids()
+        for required, excluded, extensions, ratings in self.rules:
+            if not required <= tag_ids or not excluded.isdisjoint(tag_ids):
+                continue
+            if extensions and record.ext not in extensions:
+                continue
+            if ratings and record.rating not in ratings:
+                continue
+            return True
+        return False
+
+    def apply(self, records):
+        return [record for record in records if not self.rejects(record)]
+
+@lru_cache(maxsize=64)
+def _compile_result_filter(blacklist, removeanimated):
+    """Compile blacklist text into a _ResultFilter.
+
+    Args:
+        blacklist (str): One rule per line. A rule is a list of tags, delimited by spaces, that
+            must all be present for a post to be hidden. A tag starting with - must be absent instead,
+            and ext:gif or rating:e tokens (comma separated for several) match the file type and rating.
+        removeanimated (bool): True to also hide the "animated" tag and animation-only file types
+
+    Returns:
+        _ResultFilter or None: None when nothing would ever be hidden
+    """
+    lines = [line.split() for line in (blacklist or "").splitlines()]
     if removeanimated:
-        if query:
-            query += " "
-        query += "-animated"
-    return query.strip()
+        lines.append(["animated"])
+        lines.extend([f"ext:{ext}"] for ext in ANIMATED_EXTENSIONS)
+
+    rules = []
+    for tokens in lines:
+        required, excluded, extensions, ratings = set(), set(), set(), set()
+        for token in tokens:
+            lower = token.lower()
+            if lower.startswith("ext:"):
+                extensions.update(value.lstrip(".") for value in lower[4:].split(",") if value)
+            elif lower.startswith("rating:"):
+                ratings.update(value[0] for value in lower[7:].split(",") if value)
+            elif token.startswith("-") and len(token) > 1:
+                excluded.add(_tag_table.intern(token[1:]))
+            else:
+                required.add(_tag_table.intern(token))
+        if required or extensions or ratings:
+            rules.append((frozenset(required), frozenset(excluded), frozenset(extensions), frozenset(ratings)))
+
+    if not rules:
+        return None
+    return _ResultFilter((blacklist or "", bool(removeanimated)), tuple(rules))
 
-def _extract_post_id(reference, host):
+def _extract_post_id(reference, hosts):
     if not isinstance(reference, str):
         return None, None
 
@@ -330,8 +1595,8 @@ def _extract_post_id(reference, host):
         return trimmed, None
 
     parsed = parse.urlparse(trimmed)
-    host_netloc = parse.urlparse(host).netloc
-    if parsed.netloc and host_netloc and parsed.netloc != host_netloc:
+    host_netlocs = {parse.urlparse(host).netloc for host in hosts if host}
+    if parsed.netloc and host_netlocs and parsed.netloc not in host_netlocs:
         raise gr.Error("The provided URL does not match the selected booru.")
 
     query = parse.parse_qs(parsed.query)
@@ -345,27 +1610,182 @@ def _extract_post_id(reference, host):
 
     return None, trimmed
 
-def _normalize_post_general(post, *, image_url, artist=None, character=None, copyright=None, meta=None):
-    return {
+class _TagTable:
+    """Every tag string seen so far, each stored once and referred to by an integer id."""
+
+    __slots__ = ("_ids", "_names", "_lock")
+
+    def __init__(self):
+        self._ids = {}
+        self._names = []
+        self._lock = threading.Lock()
+
+    def intern(self, tag):
+        tag_id = self._ids.get(tag)
+        if tag_id is None:
+            with self._lock:
+                tag_id = self._ids.get(tag)
+                if tag_id is None:
+                    tag_id = len(self._names)
+                    self._names.append(tag)
+                    self._ids[tag] = tag_id
+        return tag_id
+
+    def names(self, tag_ids):
+        names = self._names
+        return [names[tag_id] for tag_id in tag_ids]
+
+    def __len__(self):
+        return len(self._names)
+
+_tag_table = _TagTable()
+
+class _PostRecord:
+    """A normalized post, small enough to cache by the tens of thousands.
+
+    All of a post's tags share one array: the first entries hold how many tags are in
+    each of POST_TAG_CATEGORIES, followed by the ids of those tags in _tag_table.
+    Use to_dict() to get the plain dict shape the UI works with.
+    """
+
+    __slots__ = ("id", "image_url", "preview_url", "file_url", "md5", "original", "rating", "ext", "tags")
+
+    def __init__(self, post_id, image_url, categories, *, preview_url=None, file_url=None, md5=None, original=False, rating=None, ext=None):
+        self.id = "" if post_id is None else str(post_id)
+        self.image_url = image_url
+        #A smaller rendition for showing in search results, when the booru has one
+        self.preview_url = preview_url or None
+        #The original file, for exports. Often the same string as image_url, so it costs nothing extra
+        self.file_url = file_url or None
+        #md5 is always that of the original file; original says whether image_url points at it
+        self.md5 = md5 or None
+        self.original = original
+        #The first letter of the booru's rating, and the original file's extension, both lowercase
+        self.rating = rating[0].lower() if rating else None
+        self.ext = ext.lower().lstrip(".") if ext else None
+        self.tags = array("I", [len(categories[name]) for name in POST_TAG_CATEGORIES])
+        for name in POST_TAG_CATEGORIES:
+            self.tags.extend(_tag_table.intern(tag) for tag in categories[name])
+
+    def category(self, name):
+        index = POST_TAG_CATEGORIES.index(name)
+        start = len(POST_TAG_CATEGORIES) + sum(self.tags[:index])
+        return _tag_table.names(self.tags[start:start + self.tags[index]])
+
+    def tag_ids(self):
+        return set(self.tags[len(POST_TAG_CATEGORIES):])
+
+    def to_dict(self):
+        normalized = {name: self.category(name) for name in POST_TAG_CATEGORIES}
+        normalized["image_url"] = self.image_url
+        return normalized
+
+    def to_json(self):
+        categories = {name: self.category(name) for name in POST_TAG_CATEGORIES}
+        return json.dumps([self.id, self.image_url, categories, self.md5, self.original, self.rating, self.ext, self.preview_url, self.file_url])
+
+    @classmethod
+    def from_json(cls, text):
+        #Posts cached by older versions lack the fields added since, at the end
+        post_id, image_url, categories, md5, original, rating, ext, *added = json.loads(text)
+        preview_url, file_url = (added + [None, None])[:2]
+        return cls(post_id, image_url, categories, preview_url=preview_url, file_url=file_url, md5=md5, original=original, rating=rating, ext=ext)
+
+#Only touched from the network loop, so it doesn't need a lock
+_post_cache = OrderedDict()
+
+def _cache_posts(host, records):
+    """Keep posts in memory, and in the cache database for every other process."""
+    records = [record for record in records if record.id]
+    for record in records:
+        _remember_post(host, record)
+    if records:
+        _write_cache_db(_store_posts, host, records, time.time())
+
+def _store_posts(db, host, records, stored):
+    with db:
+        db.executemany(
+            "INSERT OR REPLACE INTO posts (host, id, record, stored) VALUES (?, ?, ?, ?)",
+            [(host, record.id, record.to_json(), stored) for record in records],
+        )
+
+def _remember_post(host, record):
+    key = (host, record.id)
+    _post_cache[key] = record
+    _post_cache.move_to_end(key)
+    while len(_post_cache) > POST_CACHE_SIZE:
+        _post_cache.popitem(last=False)
+
+async def _cached_post(host, post_id):
+    key = (host, str(post_id))
+    record = _post_cache.get(key)
+    if record is not None:
+        _post_cache.move_to_end(key)
+        return record
+
+    #Another process may have fetched it already
+    row = await _query_cache_db(None, lambda db: db.execute(
+        "SELECT record FROM posts WHERE host = ? AND id = ? AND stored >= ?",
+        (host, str(post_id), time.time() - POST_CACHE_MAX_AGE),
+    ).fetchone())
+    if row is None:
+        return None
+    try:
+        record = _PostRecord.from_json(row[0])
+    except (ValueError, TypeError):
+        return None
+    _remember_post(host, record)
+    return record
+
+def _normalize_post_general(post, *, post_id, image_url, preview_url=None, file_url=None, md5=None, original=False, rating=None, ext=None, artist=None, character=None, copyright=None, meta=None):
+    return _PostRecord(post_id, image_url, {
         "general": _normalize_tags(post),
         "artist": _normalize_tags(artist or []),
         "character": _normalize_tags(character or []),
         "copyright": _normalize_tags(copyright or []),
         "meta": _normalize_tags(meta or []),
-        "image_url": image_url,
-    }
+    }, preview_url=preview_url, file_url=file_url, md5=md5, original=original, rating=rating, ext=ext)
+
+def _url_extension(url):
+    _, ext = os.path.splitext(parse.urlparse(url or "").path)
+    return ext or None
+
+#Every field _normalize_danbooru_post reads. Searches and post fetches ask for only these,
+#which leaves out the dozens of other fields each post carries. Keep the two in sync.
+DANBOORU_POST_FIELDS = (
+    "id",
+    "large_file_url",
+    "file_url",
+    "preview_file_url",
+    "md5",
+    "rating",
+    "file_ext",
+    "tag_string_general",
+    "tag_string_artist",
+    "tag_string_character",
+    "tag_string_copyright",
+    "tag_string_meta",
+)
 
 def _normalize_danbooru_post(post):
     image_url = post.get("large_file_url") or post.get("file_url") or post.get("preview_file_url")
     return _normalize_post_general(
         post.get("tag_string_general"),
+        post_id=post.get("id"),
         image_url=image_url,
+        preview_url=post.get("large_file_url") or post.get("preview_file_url"),
+        file_url=post.get("file_url"),
+        md5=post.get("md5"),
+        original=bool(image_url) and image_url == post.get("file_url"),
+        rating=post.get("rating"),
+        ext=post.get("file_ext"),
         artist=post.get("tag_string_artist"),
         character=post.get("tag_string_character"),
         copyright=post.get("tag_string_copyright"),
         meta=post.get("tag_string_meta"),
     )
 
+#e621 has no field selection, so its posts always arrive whole
 def _normalize_e621_post(post):
     tags = post.get("tags", {})
     general = []
@@ -375,26 +1795,59 @@ def _normalize_e621_post(post):
     image_url = image_data.get("url") or post.get("sample", {}).get("url") or post.get("preview", {}).get("url")
     return _normalize_post_general(
         general,
+        post_id=post.get("id"),
         image_url=image_url,
+        preview_url=post.get("sample", {}).get("url") or post.get("preview", {}).get("url"),
+        file_url=image_data.get("url"),
+        md5=image_data.get("md5"),
+        original=bool(image_url) and image_url == image_data.get("url"),
+        rating=post.get("rating"),
+        ext=image_data.get("ext"),
         artist=tags.get("artist", []),
         character=tags.get("character", []),
         copyright=tags.get("copyright", []),
         meta=tags.get("meta", []),
     )
 
+#Moebooru has no field selection, so its posts always arrive whole
 def _normalize_moebooru_post(post):
     image_url = post.get("file_url") or post.get("jpeg_url") or post.get("sample_url") or post.get("preview_url")
-    return _normalize_post_general(post.get("tags", ""), image_url=image_url)
+    return _normalize_post_general(
+        post.get("tags", ""),
+        post_id=post.get("id"),
+        image_url=image_url,
+        preview_url=post.get("sample_url") or post.get("preview_url"),
+        file_url=post.get("file_url"),
+        md5=post.get("md5"),
+        original=bool(image_url) and image_url == post.get("file_url"),
+        rating=post.get("rating"),
+        ext=post.get("file_ext") or _url_extension(post.get("file_url")),
+    )
 
+#Gelbooru's fields parameter only adds fields, so its posts always arrive whole
 def _normalize_gelbooru_post(post):
     image_url = post.get("file_url") or post.get("sample_url") or post.get("preview_url")
-    return _normalize_post_general(post.get("tags", ""), image_url=image_url)
+    return _normalize_post_general(
+        post.get("tags", ""),
+        post_id=post.get("id"),
+        image_url=image_url,
+        #Posts too small to need a sample have an empty sample_url, and are shown whole
+        preview_url=post.get("sample_url") or image_url,
+        file_url=post.get("file_url"),
+        #Some older Gelbooru installs call the md5 "hash"
+        md5=post.get("md5") or post.get("hash"),
+        original=bool(image_url) and image_url == post.get("file_url"),
+        rating=post.get("rating"),
+        ext=_url_extension(post.get("file_url") or post.get("image")),
+    )
 
+#Philomena has no field selection, so its images always arrive whole
 def _normalize_philomena_post(post):
     tags = post.get("tags", [])
     general = []
     artist = []
     character = []
+    rating = None
     for tag in tags:
         lower = tag.lower()
         if lower.startswith("artist:"):
@@ -403,40 +1856,256 @@ def _normalize_philomena_post(post):
             character.append(tag.split(":", 1)[1])
         else:
             general.append(tag)
+            rating = rating or PHILOMENA_RATINGS.get(lower)
+
+    #Philomena only publishes sha512 hashes, but both of these URLs serve the original file
+    representations = post.get("representations", {})
+    image_url = representations.get("full") or post.get("view_url")
+    return _normalize_post_general(
+        general,
+        post_id=post.get("id"),
+        image_url=image_url,
+        preview_url=representations.get("medium") or representations.get("thumb"),
+        file_url=image_url,
+        original=True,
+        rating=rating,
+        ext=post.get("format"),
+        artist=artist,
+        character=character,
+    )
+
+#host -> {tag: category}, for tags already read from or written to the cache database. Only touched from the network loop.
+_tag_type_cache = {}
+
+def _known_tag_types(host):
+    return _tag_type_cache.setdefault(host, {})
+
+async def _load_tag_types(host, tags):
+    """Read the categories of tags from the cache database into _known_tag_types(host).
 
-    image_url = post.get("representations", {}).get("full") or post.get("view_url")
-    return _normalize_post_general(general, image_url=image_url, artist=artist, character=character)
+    Another process may have looked them up since this one last checked.
+    """
+    _known_tag_types(host).update(await _query_cache_db([], _select_tag_types, host, tags))
+
+def _select_tag_types(db, host, tags):
+    rows = []
+    for start in range(0, len(tags), TAG_TYPE_QUERY_BATCH_SIZE):
+        batch = tags[start:start + TAG_TYPE_QUERY_BATCH_SIZE]
+        placeholders = ",".join("?" * len(batch))
+        rows.extend(db.execute(f"SELECT tag, type FROM tag_types WHERE host = ? AND tag IN ({placeholders})", (host, *batch)))
+    return rows
+
+def _remember_tag_types(host, resolved):
+    known = _known_tag_types(host)
+    new_types = {tag: category for tag, category in resolved.items() if known.get(tag) != category}
+    if not new_types:
+        return
+    known.update(new_types)
+    _write_cache_db(_store_tag_types, host, new_types)
 
-@lru_cache(maxsize=None)
-def detect_booru_type(host, username="", apikey="", cookie=""):
+def _store_tag_types(db, host, new_types):
+    with db:
+        db.executemany("INSERT OR REPLACE INTO tag_types (host, tag, type) VALUES (?, ?, ?)", [(host, tag, category) for tag, category in new_types.items()])
+
+def _tag_category(types, value):
+    try:
+        return types.get(int(value), "general")
+    except (TypeError, ValueError):
+        return MOEBOORU_TAG_TYPE_NAMES.get(str(value).lower(), "general")
+
+async def _lookup_gelbooru_tag_types(host, username, apikey, cookie, tags):
+    headers = _build_request_headers(username, apikey, cookie, auth_mode="gelbooru")
+
+    async def lookup_batch(batch):
+        params = _query_with_auth(
+            {
+                "page": "dapi",
+                "s": "tag",
+                "q": "index",
+                "json": 1,
+                "limit": len(batch),
+                "names": " ".join(batch),
+            },
+            username,
+            apikey,
+            auth_mode="gelbooru",
+        )
+        data = await _fetch_json(f"{host}/index.php?{parse.urlencode(params)}", headers=headers, raise_for_status=False)
+        entries = data.get("tag", []) if isinstance(data, dict) else data
+        if isinstance(entries, dict):
+            entries = [entries]
+        if not isinstance(entries, list):
+            #Not every Gelbooru install has a JSON tag API, so these tags stay uncategorized
+            return {}
+
+        resolved = {tag: "general" for tag in batch}
+        for entry in entries:
+            if isinstance(entry, dict) and entry.get("name") in resolved:
+                resolved[entry["name"]] = _tag_category(GELBOORU_TAG_TYPES, entry.get("type"))
+        return resolved
+
+    batches = [tags[start:start + TAG_LOOKUP_BATCH_SIZE] for start in range(0, len(tags), TAG_LOOKUP_BATCH_SIZE)]
+    resolved = {}
+    for result in await asyncio.gather(*(lookup_batch(batch) for batch in batches)):
+        resolved.update(result)
+    return resolved
+
+async def _lookup_moebooru_tag_types(host, username, apikey, cookie, tags):
+    #Moebooru can only look tags up one name at a time
+    headers = _build_request_headers(username, apikey, cookie, auth_mode="moebooru")
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_TAG_LOOKUPS)
+
+    async def lookup(tag):
+        params = _query_with_auth({"name": tag, "limit": 10}, username, apikey, auth_mode="moebooru")
+        async with semaphore:
+            data = await _fetch_json(f"{host}/tag.json?{parse.urlencode(params)}", headers=headers, raise_for_status=False)
+        if not isinstance(data, list):
+            return tag, None
+        for entry in data:
+            if isinstance(entry, dict) and entry.get("name") == tag:
+                return tag, _tag_category(MOEBOORU_TAG_TYPES, entry.get("type"))
+        return tag, "general"
+
+    results = await asyncio.gather(*(lookup(tag) for tag in tags))
+    return {tag: category for tag, category in results if category}
+
+TAG_TYPE_LOOKUPS = {
+    "moebooru": _lookup_moebooru_tag_types,
+    "gelbooru": _lookup_gelbooru_tag_types,
+}
+
+def _recategorize(record, known):
+    general = record.category("general")
+    if not any(known.get(tag, "general") != "general" for tag in general):
+        return record
+
+    categories = {name: record.category(name) for name in POST_TAG_CATEGORIES}
+    categories["general"] = []
+    for tag in general:
+        categories[known.get(tag, "general")].append(tag)
+    return _PostRecord(
+        record.id,
+        record.image_url,
+        categories,
+        preview_url=record.preview_url,
+        file_url=record.file_url,
+        md5=record.md5,
+        original=record.original,
+        rating=record.rating,
+        ext=record.ext,
+    )
+
+async def _categorize_records(host, username, apikey, cookie, booru_type, records, *, lookup=True):
+    """Sort the tags of posts from boorus that only list tags flatly into their categories.
+
+    Args:
+        records (list): _PostRecords with every tag in "general"
+        lookup (bool, optional): False to only use categories that are already cached. Defaults to True.
+
+    Returns:
+        list: The records, rebuilt wherever a tag turned out to belong to another category
+    """
+    known = _known_tag_types(host)
+    unresolved = sorted({tag for record in records for tag in record.category("general") if tag not in known})
+    if unresolved:
+        await _load_tag_types(host, unresolved)
+        unresolved = [tag for tag in unresolved if tag not in known]
+    if unresolved and lookup:
+        with _span("look up tag types", "call", tags=len(unresolved)):
+            _remember_tag_types(host, await TAG_TYPE_LOOKUPS[booru_type](host, username, apikey, cookie, unresolved))
+    return [_recategorize(record, known) for record in records]
+
+def _remember_moebooru_tag_types(host, data):
+    #Moebooru installs that understand include_tags=1 send the type of every tag on the page for free
+    if isinstance(data, dict) and isinstance(data.get("tags"), dict):
+        _remember_tag_types(host, {tag: MOEBOORU_TAG_TYPE_NAMES.get(str(kind).lower(), "general") for tag, kind in data["tags"].items()})
+        return data.get("posts", [])
+    return data
+
+#Detected types already read from or written to the cache database. Only touched from the network loop.
+_detected_booru_types = {}
+
+def _detection_key(host, username, apikey, cookie):
+    #The cache is written to disk, so it only holds a digest of the credentials
+    credentials = hashlib.sha256(repr((username, apikey, cookie)).encode("utf-8")).hexdigest()
+    return f"{host} {credentials}"
+
+async def _known_booru_type(key):
+    booru_type = _detected_booru_types.get(key)
+    if booru_type is not None:
+        return booru_type
+
+    #Another process may have detected it already
+    row = await _query_cache_db(None, lambda db: db.execute(
+        "SELECT type FROM booru_types WHERE key = ? AND detected >= ?",
+        (key, time.time() - BOORU_TYPE_CACHE_MAX_AGE),
+    ).fetchone())
+    if row is None or row[0] not in SUPPORTED_SYSTEMS:
+        return None
+    _detected_booru_types[key] = row[0]
+    return row[0]
+
+def _remember_booru_type(key, booru_type):
+    _detected_booru_types[key] = booru_type
+    _write_cache_db(_store_booru_type, key, booru_type, time.time())
+
+def _store_booru_type(db, key, booru_type, detected):
+    with db:
+        db.execute("INSERT OR REPLACE INTO booru_types (key, type, detected) VALUES (?, ?, ?)", (key, booru_type, detected))
+
+@_profiled("detect_booru_type")
+async def detect_booru_type(host, username="", apikey="", cookie=""):
     host = (host or "").rstrip("/")
     username = username or ""
     apikey = apikey or ""
     cookie = cookie or ""
 
+    cache_key = _detection_key(host, username, apikey, cookie)
+    known = await _known_booru_type(cache_key)
+    if known is not None:
+        return known
+
     detectors = [
-        ("Danbooru/e621", lambda: _detect_danbooru(host, username, apikey, cookie)),
-        ("Moebooru", lambda: _detect_moebooru(host, username, apikey, cookie)),
-        ("Gelbooru", lambda: _detect_gelbooru(host, username, apikey, cookie)),
-        ("Philomena", lambda: _detect_philomena(host, username, apikey, cookie)),
+        ("Danbooru/e621", _detect_danbooru),
+        ("Moebooru", _detect_moebooru),
+        ("Gelbooru", _detect_gelbooru),
+        ("Philomena", _detect_philomena),
     ]
 
-    for name, detector in detectors:
-        booru_type = detector()
-        if booru_type:
-            print(f"Detected booru type: {booru_type} (matched {name} pattern)")
-            return booru_type
-
+    #Probe every system at once, then take the first match in priority order. A probe that
+    #fails, such as a challenge page on a path the booru doesn't use, only rules its system out
+    probes = [asyncio.ensure_future(detector(host, username, apikey, cookie)) for _, detector in detectors]
+    failures = []
+    try:
+        for (name, _), probe in zip(detectors, probes):
+            try:
+                booru_type = await probe
+            except Exception as error:
+                failures.append(error)
+                continue
+            if booru_type:
+                print(f"Detected booru type: {booru_type} (matched {name} pattern)")
+                _remember_booru_type(cache_key, booru_type)
+                return booru_type
+    finally:
+        #Once a system matched, the lower priority probes still running are no use
+        for probe in probes:
+            probe.cancel()
+
+    #With nothing matched, why the likeliest system failed says more than the generic message
+    if failures:
+        raise failures[0]
     raise gr.Error(
         "Unable to determine the booru type. The API did not match any known booru systems. "
         "Please verify the host URL and credentials, or manually select the booru system type in Settings."
     )
 
-def _detect_danbooru(host, username, apikey, cookie):
-    params = _query_with_auth({"limit": 1}, username, apikey, auth_mode="danbooru")
+async def _detect_danbooru(host, username, apikey, cookie):
+    #e621 ignores only=, which is fine, since it's told apart by the shape of the response
+    params = _query_with_auth({"limit": 1, "only": "id,tag_string_general"}, username, apikey, auth_mode="danbooru")
     url = f"{host}/posts.json?{parse.urlencode(params)}"
     headers = _build_request_headers(username, apikey, cookie, auth_mode="danbooru")
-    data = _fetch_json(url, headers=headers, raise_for_status=False)
+    data = await _fetch_json(url, headers=headers, raise_for_status=False)
     if not data:
         return None
 
@@ -448,16 +2117,16 @@ def _detect_danbooru(host, username, apikey, cookie):
 
     return None
 
-def _detect_moebooru(host, username, apikey, cookie):
+async def _detect_moebooru(host, username, apikey, cookie):
     params = _query_with_auth({"limit": 1}, username, apikey, auth_mode="moebooru")
     url = f"{host}/post.json?{parse.urlencode(params)}"
     headers = _build_request_headers(username, apikey, cookie, auth_mode="moebooru")
-    data = _fetch_json(url, headers=headers, raise_for_status=False)
+    data = await _fetch_json(url, headers=headers, raise_for_status=False)
     if isinstance(data, list) and data and isinstance(data[0], dict) and "tags" in data[0]:
         return "moebooru"
     return None
 
-def _detect_gelbooru(host, username, apikey, cookie):
+async def _detect_gelbooru(host, username, apikey, cookie):
     params = _query_with_auth(
         {
             "page": "dapi",
@@ -472,7 +2141,7 @@ def _detect_gelbooru(host, username, apikey, cookie):
     )
     url = f"{host}/index.php?{parse.urlencode(params)}"
     headers = _build_request_headers(username, apikey, cookie, auth_mode="gelbooru")
-    data = _fetch_json(url, headers=headers, raise_for_status=False)
+    data = await _fetch_json(url, headers=headers, raise_for_status=False)
     if isinstance(data, dict) and "post" in data:
         posts = data["post"]
         if isinstance(posts, dict) or (isinstance(posts, list) and posts):
@@ -481,22 +2150,24 @@ def _detect_gelbooru(host, username, apikey, cookie):
         return "gelbooru"
     return None
 
-def _detect_philomena(host, username, apikey, cookie):
+async def _detect_philomena(host, username, apikey, cookie):
     params = _query_with_auth({"q": "id.gt:0", "per_page": 1, "page": 1}, username, apikey, auth_mode="philomena")
     url = f"{host}/api/v1/json/search/images?{parse.urlencode(params)}"
     headers = _build_request_headers(username, apikey, cookie, auth_mode="philomena")
-    data = _fetch_json(url, headers=headers, raise_for_status=False)
+    data = await _fetch_json(url, headers=headers, raise_for_status=False)
     if isinstance(data, dict) and data.get("images") is not None:
         return "philomena"
     return None
 
-def _search_danbooru(host, username, apikey, cookie, tags, page, limit):
-    params = _query_with_auth({"limit": limit, "page": page}, username, apikey, auth_mode="danbooru")
+async def _search_danbooru(host, username, apikey, cookie, tags, page, limit, cursor=None):
+    if cursor:
+        page = _cursor_filter(cursor, style="page")
+    params = _query_with_auth({"limit": limit, "page": page, "only": ",".join(DANBOORU_POST_FIELDS)}, username, apikey, auth_mode="danbooru")
     params["tags"] = tags
     url = f"{host}/posts.json?{parse.urlencode(params)}"
     _sanitize_url_for_logging(url)
     headers = _build_request_headers(username, apikey, cookie, auth_mode="danbooru")
-    data = _safe_fetch_json(url, description="search the booru", headers=headers)
+    data = await _safe_fetch_json(url, description="search the booru", headers=headers)
     posts = data.get("posts", []) if isinstance(data, dict) else data
     if posts is None:
         posts = []
@@ -508,19 +2179,20 @@ def _search_danbooru(host, username, apikey, cookie, tags, page, limit):
         if not isinstance(post, dict) or post.get("id") is None:
             continue
         normalized = _normalize_danbooru_post(post)
-        image_url = normalized.get("image_url")
-        if not image_url:
+        if not normalized.image_url:
             continue
-        results.append({"id": str(post["id"]), "image_url": image_url})
+        results.append(normalized)
     return results
 
-def _search_e621(host, username, apikey, cookie, tags, page, limit):
+async def _search_e621(host, username, apikey, cookie, tags, page, limit, cursor=None):
+    if cursor:
+        page = _cursor_filter(cursor, style="page")
     params = _query_with_auth({"limit": limit, "page": page}, username, apikey, auth_mode="e621")
     params["tags"] = tags
     url = f"{host}/posts.json?{parse.urlencode(params)}"
     _sanitize_url_for_logging(url)
     headers = _build_request_headers(username, apikey, cookie, auth_mode="e621")
-    data = _safe_fetch_json(url, description="search the booru", headers=headers)
+    data = await _safe_fetch_json(url, description="search the booru", headers=headers)
     posts = data.get("posts", []) if isinstance(data, dict) else []
     if not isinstance(posts, list):
         raise gr.Error("Booru returned an unexpected search payload.")
@@ -530,18 +2202,20 @@ def _search_e621(host, username, apikey, cookie, tags, page, limit):
         if not isinstance(post, dict) or post.get("id") is None:
             continue
         normalized = _normalize_e621_post(post)
-        image_url = normalized.get("image_url")
-        if not image_url:
+        if not normalized.image_url:
             continue
-        results.append({"id": str(post["id"]), "image_url": image_url})
+        results.append(normalized)
     return results
 
-def _search_moebooru(host, username, apikey, cookie, tags, page, limit):
-    params = _query_with_auth({"limit": limit, "page": page, "tags": tags}, username, apikey, auth_mode="moebooru")
+async def _search_moebooru(host, username, apikey, cookie, tags, page, limit, cursor=None):
+    if cursor:
+        tags = f"{tags} {_cursor_filter(cursor, style='tag')}".strip()
+        page = 1
+    params = _query_with_auth({"limit": limit, "page": page, "tags": tags, "include_tags": 1}, username, apikey, auth_mode="moebooru")
     url = f"{host}/post.json?{parse.urlencode(params)}"
     _sanitize_url_for_logging(url)
     headers = _build_request_headers(username, apikey, cookie, auth_mode="moebooru")
-    data = _safe_fetch_json(url, description="search the booru", headers=headers)
+    data = _remember_moebooru_tag_types(host, await _safe_fetch_json(url, description="search the booru", headers=headers))
     if data is None:
         return []
     if not isinstance(data, list):
@@ -552,13 +2226,16 @@ def _search_moebooru(host, username, apikey, cookie, tags, page, limit):
         if not isinstance(post, dict) or post.get("id") is None:
             continue
         normalized = _normalize_moebooru_post(post)
-        image_url = normalized.get("image_url")
-        if not image_url:
+        if not normalized.image_url:
             continue
-        results.append({"id": str(post["id"]), "image_url": image_url})
-    return results
-
-def _search_gelbooru(host, username, apikey, cookie, tags, page, limit):
+        results.append(normalized)
+    #Single-tag lookups are too slow for a whole page, they happen when a post is selected instead
+    return await _categorize_records(host, username, apikey, cookie, "moebooru", results, lookup=False)
+
+async def _search_gelbooru(host, username, apikey, cookie, tags, page, limit, cursor=None):
+    if cursor:
+        tags = f"{tags} {_cursor_filter(cursor, style='tag')}".strip()
+        page = 1
     pid = max(page - 1, 0)
     params = _query_with_auth(
         {
@@ -577,7 +2254,7 @@ def _search_gelbooru(host, username, apikey, cookie, tags, page, limit):
     url = f"{host}/index.php?{parse.urlencode(params)}"
     _sanitize_url_for_logging(url)
     headers = _build_request_headers(username, apikey, cookie, auth_mode="gelbooru")
-    data = _safe_fetch_json(url, description="search the booru", headers=headers)
+    data = await _safe_fetch_json(url, description="search the booru", headers=headers)
     if isinstance(data, dict):
         posts = data.get("post", [])
         if isinstance(posts, dict):
@@ -594,20 +2271,28 @@ def _search_gelbooru(host, username, apikey, cookie, tags, page, limit):
         if not isinstance(post, dict) or post.get("id") is None:
             continue
         normalized = _normalize_gelbooru_post(post)
-        image_url = normalized.get("image_url")
-        if not image_url:
+        if not normalized.image_url:
             continue
-        results.append({"id": str(post["id"]), "image_url": image_url})
-    return results
+        results.append(normalized)
+    return await _categorize_records(host, username, apikey, cookie, "gelbooru", results)
 
-def _search_philomena(host, username, apikey, cookie, tags, page, limit):
+async def _search_philomena(host, username, apikey, cookie, tags, page, limit, cursor=None):
     tokens = [token for token in (tags or "").split() if token]
+    if cursor:
+        tokens.append(_cursor_filter(cursor, style="philomena"))
+        page = 1
     query_value = ",".join(tokens) if tokens else "*"
-    params = _query_with_auth({"q": query_value, "per_page": limit, "page": page}, username, apikey, auth_mode="philomena")
+    #Always sort by id so cursors and plain pages walk the results in the same order
+    params = _query_with_auth(
+        {"q": query_value, "per_page": limit, "page": page, "sf": "id", "sd": "desc"},
+        username,
+        apikey,
+        auth_mode="philomena",
+    )
     url = f"{host}/api/v1/json/search/images?{parse.urlencode(params)}"
     _sanitize_url_for_logging(url)
     headers = _build_request_headers(username, apikey, cookie, auth_mode="philomena")
-    data = _safe_fetch_json(url, description="search the booru", headers=headers)
+    data = await _safe_fetch_json(url, description="search the booru", headers=headers)
     images = data.get("images", []) if isinstance(data, dict) else []
     if not isinstance(images, list):
         raise gr.Error("Booru returned an unexpected search payload.")
@@ -617,10 +2302,9 @@ def _search_philomena(host, username, apikey, cookie, tags, page, limit):
         if not isinstance(image, dict) or image.get("id") is None:
             continue
         normalized = _normalize_philomena_post(image)
-        image_url = normalized.get("image_url")
-        if not image_url:
+        if not normalized.image_url:
             continue
-        results.append({"id": str(image["id"]), "image_url": image_url})
+        results.append(normalized)
     return results
 
 SEARCH_HANDLERS = {
@@ -631,8 +2315,8 @@ SEARCH_HANDLERS = {
     "philomena": _search_philomena,
 }
 
-def _fetch_danbooru_post(host, username, apikey, cookie, post_id, reference_url):
-    params = _query_with_auth({}, username, apikey, auth_mode="danbooru")
+async def _fetch_danbooru_post(host, username, apikey, cookie, post_id, reference_url):
+    params = _query_with_auth({"only": ",".join(DANBOORU_POST_FIELDS)}, username, apikey, auth_mode="danbooru")
     if post_id:
         url = _append_query(f"{host}/posts/{post_id}.json", params)
     elif reference_url:
@@ -645,36 +2329,37 @@ def _fetch_danbooru_post(host, username, apikey, cookie, post_id, reference_url)
 
     _sanitize_url_for_logging(url)
     headers = _build_request_headers(username, apikey, cookie, auth_mode="danbooru")
-    data = _safe_fetch_json(url, description="load post details", headers=headers)
+    data = await _safe_fetch_json(url, description="load post details", headers=headers)
     if isinstance(data, dict):
         return _normalize_danbooru_post(data)
     raise gr.Error("Booru returned an unexpected payload when loading the post.")
 
-def _fetch_e621_post(host, username, apikey, cookie, post_id, reference_url):
+async def _fetch_e621_post(host, username, apikey, cookie, post_id, reference_url):
     if not post_id:
         raise gr.Error("Unable to determine which post to load.")
     params = _query_with_auth({}, username, apikey, auth_mode="e621")
     url = _append_query(f"{host}/posts/{post_id}.json", params)
     _sanitize_url_for_logging(url)
     headers = _build_request_headers(username, apikey, cookie, auth_mode="e621")
-    data = _safe_fetch_json(url, description="load post details", headers=headers)
+    data = await _safe_fetch_json(url, description="load post details", headers=headers)
     if isinstance(data, dict) and isinstance(data.get("post"), dict):
         return _normalize_e621_post(data["post"])
     raise gr.Error("Booru returned an unexpected payload when loading the post.")
 
-def _fetch_moebooru_post(host, username, apikey, cookie, post_id, reference_url):
+async def _fetch_moebooru_post(host, username, apikey, cookie, post_id, reference_url):
     if not post_id:
         raise gr.Error("Unable to determine which post to load.")
-    params = _query_with_auth({"tags": f"id:{post_id}", "limit": 1}, username, apikey, auth_mode="moebooru")
+    params = _query_with_auth({"tags": f"id:{post_id}", "limit": 1, "include_tags": 1}, username, apikey, auth_mode="moebooru")
     url = f"{host}/post.json?{parse.urlencode(params)}"
     _sanitize_url_for_logging(url)
     headers = _build_request_headers(username, apikey, cookie, auth_mode="moebooru")
-    data = _safe_fetch_json(url, description="load post details", headers=headers)
+    data = _remember_moebooru_tag_types(host, await _safe_fetch_json(url, description="load post details", headers=headers))
     if isinstance(data, list) and data:
-        return _normalize_moebooru_post(data[0])
+        records = await _categorize_records(host, username, apikey, cookie, "moebooru", [_normalize_moebooru_post(data[0])])
+        return records[0]
     raise gr.Error("Post could not be found on the selected booru.")
 
-def _fetch_gelbooru_post(host, username, apikey, cookie, post_id, reference_url):
+async def _fetch_gelbooru_post(host, username, apikey, cookie, post_id, reference_url):
     if not post_id:
         raise gr.Error("Unable to determine which post to load.")
     params = _query_with_auth(
@@ -693,25 +2378,30 @@ def _fetch_gelbooru_post(host, username, apikey, cookie, post_id, reference_url)
     url = f"{host}/index.php?{parse.urlencode(params)}"
     _sanitize_url_for_logging(url)
     headers = _build_request_headers(username, apikey, cookie, auth_mode="gelbooru")
-    data = _safe_fetch_json(url, description="load post details", headers=headers)
+    data = await _safe_fetch_json(url, description="load post details", headers=headers)
+    post = None
     if isinstance(data, dict) and data.get("post"):
         posts = data["post"]
         if isinstance(posts, dict):
-            return _normalize_gelbooru_post(posts)
-        if isinstance(posts, list) and posts:
-            return _normalize_gelbooru_post(posts[0])
-    if isinstance(data, list) and data:
-        return _normalize_gelbooru_post(data[0])
-    raise gr.Error("Post could not be found on the selected booru.")
-
-def _fetch_philomena_post(host, username, apikey, cookie, post_id, reference_url):
+            post = posts
+        elif isinstance(posts, list) and posts:
+            post = posts[0]
+    elif isinstance(data, list) and data:
+        post = data[0]
+    if post is None:
+        raise gr.Error("Post could not be found on the selected booru.")
+
+    records = await _categorize_records(host, username, apikey, cookie, "gelbooru", [_normalize_gelbooru_post(post)])
+    return records[0]
+
+async def _fetch_philomena_post(host, username, apikey, cookie, post_id, reference_url):
     if not post_id:
         raise gr.Error("Unable to determine which post to load.")
     params = _query_with_auth({}, username, apikey, auth_mode="philomena")
     url = _append_query(f"{host}/api/v1/json/images/{post_id}", params)
     _sanitize_url_for_logging(url)
     headers = _build_request_headers(username, apikey, cookie, auth_mode="philomena")
-    data = _safe_fetch_json(url, description="load post details", headers=headers)
+    data = await _safe_fetch_json(url, description="load post details", headers=headers)
     if isinstance(data, dict) and isinstance(data.get("image"), dict):
         return _normalize_philomena_post(data["image"])
     raise gr.Error("Post could not be found on the selected booru.")
@@ -730,7 +2420,7 @@ def savesettings(active, name, host, username, apikey, cookie, system_display, n
     Args:
         active (str): The string identifier of the currently selected booru
         name (str): The updated display name for the booru
-        host (str): The base URL for the booru
+        host (str): The base URL for the booru, optionally followed by mirrors, separated by commas
         username (str): The username for that booru
         apikey (str): The user's api key
         cookie (str): Session cookie string to include in requests
@@ -742,31 +2432,38 @@ def savesettings(active, name, host, username, apikey, cookie, system_display, n
     if not name:
         raise gr.Error("Booru name cannot be empty.")
 
-    host = _normalize_host(host)
+    hosts = _normalize_hosts(host)
 
     system_value = SYSTEM_NAME_LOOKUP.get(system_display, system_display)
     if system_value not in SUPPORTED_SYSTEMS:
         raise gr.Error("Unsupported booru system selected.")
 
-    booru_index = _find_booru_index(original_name)
-    if booru_index is None:
-        raise gr.Error(f"Booru '{original_name}' was not found.")
+    def apply(raw):
+        booru_index = _find_booru_index(raw["boorus"], original_name)
+        if booru_index is None:
+            raise gr.Error(f"Booru '{original_name}' was not found.")
 
-    if name != original_name and name in _booru_names():
-        raise gr.Error(f"A booru named '{name}' already exists.")
+        if name != original_name and _find_booru_index(raw["boorus"], name) is not None:
+            raise gr.Error(f"A booru named '{name}' already exists.")
 
-    booru = settings["boorus"][booru_index]
-    booru["name"] = name
-    booru["host"] = host
-    booru["username"] = username or ""
-    booru["apikey"] = apikey or ""
-    booru["cookie"] = cookie or ""
-    booru["system"] = system_value
+        booru = raw["boorus"][booru_index]
+        booru["name"] = name
+        booru["host"] = hosts[0]
+        booru["mirrors"] = hosts[1:]
+        booru["username"] = username or ""
+        booru["apikey"] = apikey or ""
+        booru["cookie"] = cookie or ""
+        booru["system"] = system_value
 
-    settings["active"] = name
-    settings["negativeprompt"] = negprompt
+        #Saved searches find their booru by name, so they follow it when it's renamed
+        for search in raw.get("savedsearches", []):
+            if search.get("booru") == original_name:
+                search["booru"] = name
 
-    _persist_settings()
+        raw["active"] = name
+        raw["negativeprompt"] = negprompt
+
+    _update_settings(apply)
 
     return _build_settings_outputs()
 
@@ -775,54 +2472,56 @@ def addbooru(name, host, username, apikey, cookie, system_display, negprompt):
     if not name:
         raise gr.Error("Booru name cannot be empty.")
 
-    host = _normalize_host(host)
+    hosts = _normalize_hosts(host)
 
     system_value = SYSTEM_NAME_LOOKUP.get(system_display, system_display)
     if system_value not in SUPPORTED_SYSTEMS:
         raise gr.Error("Unsupported booru system selected.")
 
-    if name in _booru_names():
-        raise gr.Error(f"A booru named '{name}' already exists.")
+    def apply(raw):
+        if _find_booru_index(raw["boorus"], name) is not None:
+            raise gr.Error(f"A booru named '{name}' already exists.")
 
-    settings["boorus"].append({
-        "name": name,
-        "host": host,
-        "username": username or "",
-        "apikey": apikey or "",
-        "cookie": cookie or "",
-        "system": system_value,
-    })
+        raw["boorus"].append({
+            "name": name,
+            "host": hosts[0],
+            "mirrors": hosts[1:],
+            "username": username or "",
+            "apikey": apikey or "",
+            "cookie": cookie or "",
+            "system": system_value,
+        })
 
-    settings["active"] = name
-    settings["negativeprompt"] = negprompt
+        raw["active"] = name
+        raw["negativeprompt"] = negprompt
 
-    _persist_settings()
+    _update_settings(apply)
 
     return _build_settings_outputs()
 
 def removebooru(active, negprompt):
-    if len(settings.get("boorus", [])) <= 1:
-        raise gr.Error("At least one booru must remain.")
+    def apply(raw):
+        if len(raw.get("boorus", [])) <= 1:
+            raise gr.Error("At least one booru must remain.")
 
-    booru_index = _find_booru_index(active)
-    if booru_index is None:
-        raise gr.Error(f"Booru '{active}' was not found.")
+        booru_index = _find_booru_index(raw["boorus"], active)
+        if booru_index is None:
+            raise gr.Error(f"Booru '{active}' was not found.")
 
-    removed = settings["boorus"].pop(booru_index)
+        #If the active booru was the one removed, normalizing the settings falls back to the first one
+        raw["boorus"].pop(booru_index)
+        #Its saved searches could never be refreshed again
+        raw["savedsearches"] = [search for search in raw.get("savedsearches", []) if search.get("booru") != active]
+        raw["negativeprompt"] = negprompt
 
-    settings["negativeprompt"] = negprompt
-
-    if settings["active"] == removed["name"]:
-        _ensure_active()
-    else:
-        _ensure_active(settings["active"])
-
-    _persist_settings()
+    _update_settings(apply)
 
     return _build_settings_outputs()
 
 #We're loading the settings here since all the further functions depend on this existing already
-settings = loadsettings()
+_settings_snapshot = _SettingsSnapshot(loadsettings())
+_settings_file_mtime = os.stat(SETTINGS_PATH).st_mtime_ns
+atexit.register(_flush_settings)
 
 def getauth():
     """Get the username and api key for the currently selected booru
@@ -860,19 +2559,50 @@ def gethost():
     return ""
 
 def _get_active_booru():
-    active_name = _ensure_active()
-    for booru in settings.get('boorus', []):
-        if booru.get('name') == active_name:
-            return booru
-    return None
+    snapshot = _current_settings()
+    return snapshot.by_name.get(snapshot.active)
+
+def _booru_context(booru_name=None):
+    """Take a private copy of one booru's connection details for the duration of a request.
+
+    Args:
+        booru_name (str, optional): The booru the request was made against. Defaults to the active booru.
+
+    Returns:
+        dict: name, host, hosts (the host and its mirrors), username, apikey, cookie and system for that booru
+    """
+    snapshot = _current_settings()
+    booru = snapshot.by_name.get(booru_name or snapshot.active)
+    if booru is None and booru_name:
+        raise gr.Error(f"Booru '{booru_name}' was not found.")
+    if booru is None:
+        raise gr.Error("No booru is configured.")
+
+    system = (booru.get("system", "auto") or "auto").lower()
+    if system not in SUPPORTED_SYSTEMS:
+        system = "auto"
 
-def searchbooru(query, removeanimated, curpage, pagechange=0):
-    """Search the currently selected booru, and return a list of images and the current page.
+    return {
+        "name": booru.get("name", ""),
+        "host": booru.get("host", ""),
+        "hosts": _booru_hosts(booru),
+        "username": booru.get("username", ""),
+        "apikey": booru.get("apikey", ""),
+        "cookie": booru.get("cookie", ""),
+        "system": system,
+    }
+
+@_profiled("searchbooru")
+async def searchbooru(query, removeanimated, curpage, booru_name=None, blacklist="", request: gr.Request = None, *, pagechange=0):
+    """Search the selected booru, and return a list of images and the current page.
 
     Args:
         query (str): A list of tags to search for, delimited by spaces
-        removeanimated (bool): True to append -animated to searches
+        removeanimated (bool): True to hide results with the "animated" tag
         curpage (str or int): The current page to search
+        booru_name (str, optional): The booru selected in the caller's session. Defaults to the active booru.
+        blacklist (str, optional): Rules for results to hide, see _compile_result_filter. Defaults to "".
+        request (gr.Request, optional): Filled in by Gradio. A newer search from the same session cancels this one.
         pagechange (int, optional): How much to change the current page by before searching. Defaults to 0.
 
     Returns:
@@ -880,19 +2610,8 @@ def searchbooru(query, removeanimated, curpage, pagechange=0):
         a str filepath to a locally saved image, and [1] is a string representation
         of the id for that image on the searched booru.
         The string in this return is new current page number, which may or may not have been changed.
+        If a newer search replaced this one, both are no-op updates instead.
     """
-    host = gethost()
-    u, a = getauth()
-    cookie = getcookie()
-    booru = _get_active_booru() or {}
-    system_override = (booru.get("system", "auto") or "auto").lower()
-    if system_override not in SUPPORTED_SYSTEMS:
-        system_override = "auto"
-    if system_override == "auto":
-        booru_type = detect_booru_type(host, u, a, cookie)
-    else:
-        booru_type = system_override
-
     #If the page isn't changing, then the user almost certainly is initiating a new
     #search, so we can set the page number back to 1.
     if pagechange == 0:
@@ -906,49 +2625,309 @@ def searchbooru(query, removeanimated, curpage, pagechange=0):
         if curpage < 1:
             curpage = 1
 
+    return await _search_to_page(query, removeanimated, curpage, booru_name, blacklist, request)
+
+@_profiled("gotopage")
+async def gotopage(query, removeanimated, page, booru_name=None, blacklist="", request: gr.Request = None):
+    """Jump straight to a page of the current search.
+
+    Args:
+        query (str): A list of tags to search for, delimited by spaces
+        removeanimated (bool): True to hide results with the "animated" tag
+        page (float or int): The page to jump to
+        booru_name (str, optional): The booru selected in the caller's session. Defaults to the active booru.
+        blacklist (str, optional): Rules for results to hide, see _compile_result_filter. Defaults to "".
+        request (gr.Request, optional): Filled in by Gradio. A newer search from the same session cancels this one.
+
+    Returns:
+        tuple (list, str): The same gallery list and page number searchbooru returns
+    """
+    try:
+        page = int(page)
+    except (TypeError, ValueError):
+        raise gr.Error("Enter a page number to jump to.")
+    return await _search_to_page(query, removeanimated, max(page, 1), booru_name, blacklist, request)
+
+async def _search_to_page(query, removeanimated, page, booru_name, blacklist, request=None):
+    context = _booru_context(booru_name)
+    tags = _build_tag_query(query)
+    result_filter = _compile_result_filter(blacklist or "", bool(removeanimated))
+    session = getattr(request, "session_hash", None)
+    images = await _run_latest_search(session, _search_gallery(context, tags, page, result_filter))
+    if images is None:
+        #A newer search from this session took over, so leave the gallery to it
+        return gr.update(), gr.update()
+
     #We're about to use this in a url, so make it a string real quick
-    curpage = str(curpage)
+    return images, str(page)
+
+#The search each session is waiting on. Only touched from Gradio's event loop, so it doesn't need a lock
+_session_searches = {}
+
+async def _run_latest_search(session, coro):
+    """Run a search on the network loop, cancelling whatever search this session started before it.
+
+    Cancelling a search also cancels its API call and any preview downloads nobody else
+    is waiting on.
+
+    Args:
+        session (str): The Gradio session the search came from. None disables cancellation.
+        coro (coroutine): The search to run
+
+    Returns:
+        The search's result, or None if a newer search from the same session replaced it
+    """
+    future = _submit_to_network_loop(coro)
+    if session is not None:
+        previous = _session_searches.get(session)
+        if previous is not None:
+            previous.cancel()
+        _session_searches[session] = future
+
+    try:
+        result = await asyncio.wrap_future(future)
+    except asyncio.CancelledError:
+        if _session_searches.get(session, future) is future:
+            #Nothing replaced this search, so it was the caller that cancelled it
+            raise
+        return None
+    finally:
+        superseded = _session_searches.get(session, future) is not future
+        if not superseded and session is not None:
+            del _session_searches[session]
+
+    #It may have finished just as a newer search started, so check before handing it back
+    return None if superseded else result
+
+async def _resolve_booru_type(context):
+    if context["system"] == "auto":
+        return await detect_booru_type(context["host"], context["username"], context["apikey"], context["cookie"])
+    return context["system"]
+
+async def _search_records(context, tags, page, limit, result_filter):
+    """Fetch one page of search results and cache every post on it.
+
+    Returns:
+        (str, list of _PostRecord): The booru's type and the page's posts
+    """
+    booru_type = await _resolve_booru_type(context)
 
     handler = SEARCH_HANDLERS.get(booru_type)
     if handler is None:
         raise gr.Error(f"Search is not supported for booru type '{booru_type}'.")
 
-    tags = _build_tag_query(query, removeanimated)
-    results = handler(host, u, a, cookie, tags, int(curpage), 6)
+    results = await _search_page(handler, context, booru_type, tags, page, limit, result_filter)
+    _cache_posts(context["host"], results)
+    return booru_type, results
+
+async def _search_gallery(context, tags, page, result_filter):
+    """Fetch one page of search results as gallery entries of (image URL, "id:xxxxxx").
+
+    Nothing is downloaded here. Boorus that serve images without credentials get their
+    own image URLs, which the browser loads straight from the booru. The rest get signed
+    links to the image proxy, which streams each image through without writing it to disk.
+    """
+    booru_type, results = await _search_records(context, tags, page, SEARCH_PAGE_SIZE, result_filter)
 
-    temp_dir = os.path.join(edirectory, "tempimages")
-    os.makedirs(temp_dir, exist_ok=True)
+    host = context["host"]
+    headers = _build_request_headers(context["username"], context["apikey"], context["cookie"], auth_mode=booru_type)
 
-    localimages = []
-    for index, item in enumerate(results):
-        image_url = _absolute_url(host, item.get("image_url"))
+    gallery = []
+    for item in results:
+        #The full image is only fetched when a post is selected, for its tags
+        image_url = _absolute_url(host, item.preview_url or item.image_url)
         if not image_url:
             continue
+        if _image_needs_credentials(context, image_url, headers):
+            image_url = _proxied_image_url(context["name"], image_url)
+        gallery.append((image_url, f"id:{item.id}"))
+    return gallery
+
+def _image_needs_credentials(context, image_url, headers):
+    if not headers:
+        return False
+    #Browser challenges usually cover the image host too
+    if context["cookie"]:
+        return True
+    #API keys only matter to the booru itself, not to a separate image host
+    netloc = parse.urlparse(image_url).netloc
+    return any(parse.urlparse(host).netloc == netloc for host in context["hosts"])
+
+#Signs the links handed out to the image proxy, so it only ever fetches images a search returned.
+#A new key every start is fine, since the links only need to last as long as the page showing them
+_image_proxy_key = secrets.token_bytes(32)
+
+def _image_proxy_signature(booru_name, url):
+    return hmac.new(_image_proxy_key, f"{booru_name}\n{url}".encode("utf-8"), "sha256").hexdigest()
+
+def _proxied_image_url(booru_name, url):
+    query = parse.urlencode({"booru": booru_name, "url": url, "signature": _image_proxy_signature(booru_name, url)})
+    #Relative, so it still resolves when the webui is served from a subpath
+    return f"{IMAGE_PROXY_PATH.lstrip('/')}?{query}"
+
+async def _proxy_image(booru: str, url: str, signature: str):
+    """Stream a search image from a booru that needs credentials for it, without touching the disk."""
+    if not hmac.compare_digest(signature, _image_proxy_signature(booru, url)):
+        raise HTTPException(status_code=403, detail="This image link wasn't issued by this webui.")
+    try:
+        context = _booru_context(booru)
+    except gr.Error as error:
+        raise HTTPException(status_code=404, detail=getattr(error, "message", None) or str(error))
+
+    try:
+        response = await _run_on_network_loop(_open_image_stream(context, url))
+    except httpx.HTTPError as error:
+        raise HTTPException(status_code=502, detail=f"The image couldn't be loaded ({type(error).__name__}).")
+    if response.status_code >= 400:
+        await _run_on_network_loop(response.aclose())
+        raise HTTPException(status_code=502, detail=f"The booru answered HTTP {response.status_code}.")
+
+    chunks = response.aiter_bytes()
 
-        savepath = _prepare_local_image_path(index, image_url)
-        request_headers = _build_request_headers(u, a, cookie, auth_mode=booru_type)
+    async def next_chunk():
+        return await anext(chunks, None)
+
+    async def body():
+        #The connection belongs to the network loop, so every read happens there
         try:
-            _download_to_path(image_url, savepath, headers=request_headers)
-        except Exception as error:
-            print(f"Failed to cache preview {image_url}: {error}")
-            continue
+            while (chunk := await _run_on_network_loop(next_chunk())) is not None:
+                yield chunk
+        finally:
+            await _run_on_network_loop(response.aclose())
+
+    headers = {"Cache-Control": f"private, max-age={IMAGE_PROXY_MAX_AGE}"}
+    if "content-length" in response.headers and "content-encoding" not in response.headers:
+        headers["Content-Length"] = response.headers["content-length"]
+    return StreamingResponse(body(), media_type=response.headers.get("content-type", "application/octet-stream"), headers=headers)
+
+async def _open_image_stream(context, url):
+    booru_type = await _resolve_booru_type(context)
+    headers = _build_request_headers(context["username"], context["apikey"], context["cookie"], auth_mode=booru_type)
+    client = _get_http_client()
+    with _span("proxy image", "http", url=url):
+        return await client.send(client.build_request("GET", url, headers=headers), stream=True)
+
+class _RemoteGallery(gr.Gallery):
+    """A Gallery that hands image URLs to the browser untouched.
+
+    Gradio's own Gallery checks every URL with a request from the server, and its file
+    route checks again before redirecting, which is a server round trip per image that
+    this gallery skips. Anything that isn't a URL is handled as usual.
+    """
 
-        localimages.append((savepath, f"id:{item['id']}"))
+    #Gradio names a component's frontend after its class, unless it's a template of its base class
+    is_template = True
+
+    def postprocess(self, y):
+        output = []
+        for entry in y or []:
+            image, caption = entry if isinstance(entry, (tuple, list)) else (entry, None)
+            if isinstance(image, str) and (image.startswith(("http://", "https://")) or image.startswith(IMAGE_PROXY_PATH.lstrip("/"))):
+                item = {"name": image, "data": image, "is_file": False}
+                output.append(item if caption is None else [item, caption])
+            else:
+                output.extend(super().postprocess([entry]))
+        return output
+
+#Only touched from the network loop, so it doesn't need a lock
+_page_cursors = OrderedDict()
+
+def _query_cursors(context, tags, limit, result_filter):
+    """Return the page -> cursor map for one query, where each cursor is the lowest id on the page before."""
+    key = (context["host"], context["username"], tags, limit, result_filter.key if result_filter else None)
+    cursors = _page_cursors.get(key)
+    if cursors is None:
+        cursors = {}
+        _page_cursors[key] = cursors
+        while len(_page_cursors) > PAGE_CURSOR_QUERIES:
+            _page_cursors.popitem(last=False)
+    else:
+        _page_cursors.move_to_end(key)
+    return cursors
 
-    return localimages, curpage
+def _lowest_id(records):
+    try:
+        return min(int(record.id) for record in records)
+    except ValueError:
+        return None
 
-def gotonextpage(query, removeanimated, curpage):
-    return searchbooru(query, removeanimated, curpage, pagechange=1)
+def _highest_id(records):
+    try:
+        return max(int(record.id) for record in records)
+    except ValueError:
+        return None
 
-def gotoprevpage(query, removeanimated, curpage):
-    return searchbooru(query, removeanimated, curpage, pagechange=-1)
+async def _filtered_pages(handler, args, cursor, limit, batch_size, result_filter):
+    """Walk the results below cursor, yielding pages of limit posts that passed the filter.
 
-def updatesettings(active = settings['active']):
+    Each page comes with the cursor for the page after it. Posts are fetched batch_size
+    at a time, so pages stay full however many posts the filter hides.
+    """
+    accepted = []
+    exhausted = False
+    while True:
+        while len(accepted) < limit and not exhausted:
+            with _span("search", "call", limit=batch_size, before=cursor):
+                fetched = await handler(*args, 1, batch_size, cursor=("before", cursor) if cursor else None)
+            lowest = _lowest_id(fetched) if fetched else None
+            exhausted = len(fetched) < batch_size or lowest is None
+            cursor = lowest
+            accepted.extend(result_filter.apply(fetched) if result_filter else fetched)
+
+        page, accepted = accepted[:limit], accepted[limit:]
+        if not page:
+            return
+        yield page, _lowest_id(page)
+        if len(page) < limit:
+            return
+
+async def _search_page(handler, context, booru_type, tags, page, limit, result_filter=None):
+    """Fetch one page of results, using id cursors instead of page numbers wherever the booru allows.
+
+    Cursors make page 500 cost the same as page 1. Jumping past the last page with a known
+    cursor skips ahead with the largest pages the API allows, recording every page boundary
+    on the way so later paging in that range is cursor-based too. Results the filter
+    rejects are dropped before anything is downloaded, and more are fetched to keep the page full.
+    """
+    args = (context["host"], context["username"], context["apikey"], context["cookie"], tags)
+    if not _supports_cursor(tags):
+        #Page numbers are the booru's own, so filtered pages can only come up short here
+        results = await handler(*args, page, limit)
+        return result_filter.apply(results) if result_filter else results
+
+    cursors = _query_cursors(context, tags, limit, result_filter)
+    known_page = max((known for known in cursors if known <= page), default=1)
+    cursor = cursors.get(known_page)
+
+    max_batch = max(MAX_PAGE_SIZES.get(booru_type, limit), limit)
+    if known_page < page:
+        batch_size = max_batch
+    elif result_filter:
+        batch_size = min(limit * FILTER_OVERFETCH_FACTOR, max_batch)
+    else:
+        batch_size = limit
+
+    async for records, next_cursor in _filtered_pages(handler, args, cursor, limit, batch_size, result_filter):
+        if next_cursor is not None:
+            cursors[known_page + 1] = next_cursor
+        if known_page == page:
+            return records
+        known_page += 1
+    #The results ran out before reaching the requested page
+    return []
+
+async def gotonextpage(query, removeanimated, curpage, booru_name=None, blacklist="", request: gr.Request = None):
+    return await searchbooru(query, removeanimated, curpage, booru_name, blacklist, request, pagechange=1)
+
+async def gotoprevpage(query, removeanimated, curpage, booru_name=None, blacklist="", request: gr.Request = None):
+    return await searchbooru(query, removeanimated, curpage, booru_name, blacklist, request, pagechange=-1)
+
+def updatesettings(active=None):
     """Update the relevant textboxes in Gradio with the appropriate data when
     the user selects a new booru in the dropdown
 
     Args:
-        active (str, optional): The str name of the booru the user switched to. Defaults to settings['active'].
+        active (str, optional): The str name of the booru the user switched to. Defaults to the active booru.
 
     Returns:
         (str, str, str, str, str, str): The username, apikey, current booru label text,
@@ -956,7 +2935,7 @@ def updatesettings(active = settings['active']):
     """
     active_name = _ensure_active(active)
 
-    booru = next((b for b in settings['boorus'] if b['name'] == active_name), None)
+    booru = _current_settings().by_name.get(active_name)
 
     if not booru:
         system_display = SYSTEM_DISPLAY_NAMES["auto"]
@@ -971,11 +2950,12 @@ def updatesettings(active = settings['active']):
         active_name,
         active_name,
         booru.get('name', ''),
-        booru.get('host', ''),
+        _format_hosts(booru),
         system_display,
     )
 
-def grabtags(url, negprompt, replacespaces, replaceunderscores, includeartist, includecharacter, includecopyright, includemeta):
+@_profiled("grabtags")
+async def grabtags(url, negprompt, replacespaces, replaceunderscores, includeartist, includecharacter, includecopyright, includemeta, booru_name=None):
     """Get the tags for the selected post and update all the relevant textboxes on the Select tab.
 
     Args:
@@ -987,6 +2967,7 @@ def grabtags(url, negprompt, replacespaces, replaceunderscores, includeartist, i
         includecharacter (bool): True to include the character tags in the final tag string
         includecopyright (bool): True to include the copyright tags in the final tag string
         includemeta (bool): True to include the meta tags in the final tags string
+        booru_name (str, optional): The booru selected in the caller's session. Defaults to the active booru.
 
     Returns:
         (str, str, str, str, str, str): A bunch of strings that will update some gradio components.
@@ -996,64 +2977,865 @@ def grabtags(url, negprompt, replacespaces, replaceunderscores, includeartist, i
     if not isinstance(url, str):
         return
 
-    host = gethost()
-    username, apikey = getauth()
-    cookie = getcookie()
-    booru = _get_active_booru() or {}
-    system_override = (booru.get("system", "auto") or "auto").lower()
-    if system_override not in SUPPORTED_SYSTEMS:
-        system_override = "auto"
-    if system_override == "auto":
-        booru_type = detect_booru_type(host, username, apikey, cookie)
-    else:
-        booru_type = system_override
-
-    post_id, reference_url = _extract_post_id(url, host)
-    fetcher = POST_FETCHERS.get(booru_type)
-    if fetcher is None:
-        raise gr.Error(f"Loading posts is not supported for booru type '{booru_type}'.")
-
-    normalized = fetcher(host, username, apikey, cookie, post_id, reference_url)
+    context = _booru_context(booru_name)
+    post_id, reference_url = _extract_post_id(url, context["hosts"])
 
-    image_url = _absolute_url(host, normalized.get("image_url"))
-    if not image_url:
-        raise gr.Error("The selected post did not include an image URL.")
+    savepath = os.path.join(await asyncio.to_thread(_request_output_dir), "temp.jpg")
+    record = await _run_on_network_loop(_fetch_post_and_image(context, post_id, reference_url, savepath))
+    normalized = record.to_dict()
 
     artisttags = " ".join(normalized.get("artist", []))
     charactertags = " ".join(normalized.get("character", []))
     copyrighttags = " ".join(normalized.get("copyright", []))
     metatags = " ".join(normalized.get("meta", []))
-    generaltags = " ".join(normalized.get("general", []))
+
+    tags = _assemble_tags(normalized, replacespaces, replaceunderscores, includeartist, includecharacter, includecopyright, includemeta)
+
+    if negprompt:
+        tags += f"\nNegative prompt: {negprompt}"
+
+    return (tags, savepath, artisttags, charactertags, copyrighttags, metatags)
+
+async def findpost(image, booru_name=None):
+    """Find which post a local image came from, among every image already cached from the booru.
+
+    Args:
+        image (str): Path to the image to look up
+        booru_name (str, optional): The booru selected in the caller's session. Defaults to the active booru.
+
+    Returns:
+        str: An "id:xxxxxx" reference to the closest matching post, ready for grabtags
+    """
+    if not image:
+        raise gr.Error("Choose an image to look up.")
+
+    context = _booru_context(booru_name)
+    match = await _run_on_network_loop(_find_indexed_post(context["host"], image))
+    if match is None:
+        raise gr.Error("No cached post looks like this image. Only images already downloaded from this booru through the extension can be found.")
+
+    post_id, distance = match
+    print(f"Matched image to post {post_id} ({distance} bits apart)")
+    return f"id:{post_id}"
+
+def _assemble_tags(normalized, replacespaces, replaceunderscores, includeartist, includecharacter, includecopyright, includemeta):
+    """Build the final tag string for a post from its categorized tags.
+
+    Args:
+        normalized (dict): A post in the shape returned by _PostRecord.to_dict()
+        The remaining arguments match the checkboxes on the Select tab, see grabtags.
+
+    Returns:
+        str: The tag string, without any negative prompt
+    """
+    included = {
+        "artist": includeartist,
+        "character": includecharacter,
+        "copyright": includecopyright,
+        "meta": includemeta,
+        "general": True,
+    }
 
     tag_sections = []
-    if includeartist and artisttags:
-        tag_sections.append(artisttags)
-    if includecharacter and charactertags:
-        tag_sections.append(charactertags)
-    if includecopyright and copyrighttags:
-        tag_sections.append(copyrighttags)
-    if includemeta and metatags:
-        tag_sections.append(metatags)
-    if generaltags:
-        tag_sections.append(generaltags)
-
-    tags = " ".join(section for section in tag_sections if section)
+    for category in ("artist", "character", "copyright", "meta", "general"):
+        section = " ".join(normalized.get(category, []))
+        if included[category] and section:
+            tag_sections.append(section)
+
+    tags = " ".join(tag_sections)
 
     if replacespaces:
         tags = tags.replace(" ", ", ")
     if replaceunderscores:
         tags = tags.replace("_", " ")
 
-    if negprompt:
-        tags += f"\nNegative prompt: {negprompt}"
+    return tags
 
-    temp_dir = os.path.join(edirectory, "tempimages")
-    os.makedirs(temp_dir, exist_ok=True)
-    savepath = os.path.join(temp_dir, "temp.jpg")
-    headers = _build_request_headers(username, apikey, cookie, auth_mode=booru_type)
-    _download_to_path(image_url, savepath, headers=headers)
+async def _fetch_post_and_image(context, post_id, reference_url, savepath):
+    booru_type, record = await _fetch_post(context, post_id, reference_url)
 
-    return (tags, savepath, artisttags, charactertags, copyrighttags, metatags)
+    host = context["host"]
+    image_url = _absolute_url(host, record.image_url)
+    if not image_url:
+        raise gr.Error("The selected post did not include an image URL.")
+
+    headers = _build_request_headers(context["username"], context["apikey"], context["cookie"], auth_mode=booru_type)
+    await _download_image(image_url, savepath, headers=headers, md5=record.md5, original=record.original, post=(host, record.id))
+    return record
+
+async def _fetch_post(context, post_id, reference_url):
+    """Load one post from the post cache, or from the booru when it isn't cached.
+
+    Returns:
+        (str, _PostRecord): The booru's type and the post, with every tag categorized
+    """
+    booru_type = await _resolve_booru_type(context)
+
+    fetcher = POST_FETCHERS.get(booru_type)
+    if fetcher is None:
+        raise gr.Error(f"Loading posts is not supported for booru type '{booru_type}'.")
+
+    host = context["host"]
+    username, apikey, cookie = context["username"], context["apikey"], context["cookie"]
+    record = await _cached_post(host, post_id) if post_id else None
+    if record is None:
+        record = await fetcher(host, username, apikey, cookie, post_id, reference_url)
+        _cache_posts(host, [record])
+    elif booru_type in TAG_TYPE_LOOKUPS:
+        #Search results may have skipped some tag lookups, finish them now that the post is wanted
+        record = (await _categorize_records(host, username, apikey, cookie, booru_type, [record]))[0]
+        _cache_posts(host, [record])
+    return booru_type, record
+
+class _RateLimiter:
+    """Spaces out the requests sent to one booru host, whichever export or API call sends them.
+
+    Each caller passes its own rate, and waits until that rate's interval has passed since
+    the last request any caller sent, so the host never sees more than the highest rate in use.
+    """
+
+    def __init__(self):
+        self._last = None
+        self._lock = asyncio.Lock()
+
+    async def acquire(self, rate):
+        if not rate or rate <= 0:
+            return
+        async with self._lock:
+            now = time.monotonic()
+            start = now if self._last is None else max(now, self._last + 1.0 / rate)
+            if start > now:
+                await asyncio.sleep(start - now)
+            self._last = start
+
+#One limiter per booru host, so exports and API calls running at once share the host's budget.
+#Only used on the network loop, which owns every limiter's lock
+_host_rate_limiters = {}
+
+def _host_rate_limiter(host):
+    key = parse.urlparse(host).netloc or host
+    limiter = _host_rate_limiters.get(key)
+    if limiter is None:
+        limiter = _host_rate_limiters[key] = _RateLimiter()
+    return limiter
+
+#Output folders with an export running in them, so two exports never write the same manifest
+_active_exports = set()
+
+async def exportdataset(query, removeanimated, outputdir, maxposts, concurrency, ratelimit, replacespaces, replaceunderscores, includeartist, includecharacter, includecopyright, includemeta, booru_name=None, blacklist=""):
+    """Download every post matching a search, along with a caption file for each one.
+
+    Captions are built with the same tag options as the Select tab and written next to
+    each image as a .txt file, which is the layout kohya-style trainers expect. Finished
+    posts are recorded in a manifest in the output folder, so running the same export
+    again resumes it instead of starting over.
+
+    Args:
+        query (str): A list of tags to search for, delimited by spaces
+        removeanimated (bool): True to skip results with the "animated" tag
+        outputdir (str): The folder to write images and captions into
+        maxposts (float): Stop once the folder holds this many posts. 0 exports every result
+        concurrency (float): How many posts to download at once
+        ratelimit (float): The most requests per second to send the booru. 0 for no limit
+        replacespaces, replaceunderscores, includeartist, includecharacter, includecopyright, includemeta (bool):
+            The tag options from the Select tab, see grabtags
+        booru_name (str, optional): The booru selected in the caller's session. Defaults to the active booru.
+        blacklist (str, optional): Rules for results to skip, see _compile_result_filter. Defaults to "".
+
+    Yields:
+        str: A progress report for the export
+    """
+    context = _booru_context(booru_name)
+
+    outputdir = (outputdir or "").strip()
+    if not outputdir:
+        raise gr.Error("Choose a folder to export into.")
+    outputdir = os.path.abspath(os.path.expanduser(outputdir))
+    os.makedirs(outputdir, exist_ok=True)
+
+    tags = _build_tag_query(query)
+    result_filter = _compile_result_filter(blacklist or "", bool(removeanimated))
+    caption_options = (replacespaces, replaceunderscores, includeartist, includecharacter, includecopyright, includemeta)
+    progress = {"exported": 0, "skipped": 0, "failed": 0, "pages": 0}
+
+    future = _submit_to_network_loop(
+        _export_dataset(context, tags, result_filter, outputdir, int(maxposts or 0), max(int(concurrency or 1), 1), float(ratelimit or 0), caption_options, progress)
+    )
+    try:
+        while not future.done():
+            yield _describe_export(progress)
+            await asyncio.sleep(EXPORT_PROGRESS_INTERVAL)
+        future.result()
+    finally:
+        #Stopping the export in the UI closes this generator, which should stop the downloads too
+        future.cancel()
+
+    yield _describe_export(progress) + f"\nFinished exporting to {outputdir}"
+
+def _describe_export(progress):
+    return (
+        f"Exported {progress['exported']} posts, skipped {progress['skipped']} already exported, "
+        f"{progress['failed']} failed. Read {progress['pages']} pages."
+    )
+
+def _read_export_manifest(manifest_path):
+    finished = set()
+    if not os.path.exists(manifest_path):
+        return finished
+    with open(manifest_path, encoding="utf-8") as file:
+        for line in file:
+            try:
+                finished.add(str(json.loads(line)["id"]))
+            except (ValueError, KeyError, TypeError):
+                #A line cut short by an interrupted run, that post just gets exported again
+                continue
+    return finished
+
+@_profiled("exportdataset")
+async def _export_dataset(context, tags, result_filter, outputdir, maxposts, concurrency, ratelimit, caption_options, progress):
+    if outputdir in _active_exports:
+        raise gr.Error("An export is already running in that folder.")
+    _active_exports.add(outputdir)
+    try:
+        booru_type = await _resolve_booru_type(context)
+        handler = SEARCH_HANDLERS.get(booru_type)
+        if handler is None:
+            raise gr.Error(f"Search is not supported for booru type '{booru_type}'.")
+
+        manifest_path = os.path.join(outputdir, EXPORT_MANIFEST_NAME)
+        finished = _read_export_manifest(manifest_path)
+        prefix = re.sub(r"[^\w.-]+", "_", context["name"]) or "post"
+        headers = _build_request_headers(context["username"], context["apikey"], context["cookie"], auth_mode=booru_type)
+        limiter = _host_rate_limiter(context["host"])
+        page_size = MAX_PAGE_SIZES.get(booru_type, 100)
+        #Keep only a couple of pages worth of posts waiting, however large the search is
+        pending = asyncio.Queue(maxsize=concurrency * 2)
+
+        with open(manifest_path, "a", encoding="utf-8") as manifest:
+            async def worker():
+                while True:
+                    record = await pending.get()
+                    if record is None:
+                        return
+                    try:
+                        await limiter.acquire(ratelimit)
+                        await _export_post(context["host"], record, outputdir, prefix, headers, caption_options)
+                    except asyncio.CancelledError:
+                        raise
+                    except Exception as error:
+                        progress["failed"] += 1
+                        print(f"Failed to export post {record.id}: {error}")
+                        continue
+                    with _span("write manifest", "file"):
+                        manifest.write(json.dumps({"id": record.id}) + "\n")
+                        manifest.flush()
+                    progress["exported"] += 1
+
+            workers = [asyncio.create_task(worker()) for _ in range(concurrency)]
+            try:
+                queued = 0
+                page = 1
+                while not maxposts or progress["skipped"] + queued < maxposts:
+                    await limiter.acquire(ratelimit)
+                    records = await _search_page(handler, context, booru_type, tags, page, page_size, result_filter)
+                    progress["pages"] = page
+                    for record in records:
+                        if maxposts and progress["skipped"] + queued >= maxposts:
+                            break
+                        if record.id in finished:
+                            progress["skipped"] += 1
+                            continue
+                        await pending.put(record)
+                        queued += 1
+                    if len(records) < page_size:
+                        break
+                    page += 1
+
+                for _ in workers:
+                    await pending.put(None)
+                await asyncio.gather(*workers)
+            finally:
+                for task in workers:
+                    task.cancel()
+    finally:
+        _active_exports.discard(outputdir)
+
+async def _export_post(host, record, outputdir, prefix, headers, caption_options):
+    with _span("export post", "call", id=record.id):
+        await _export_post_files(host, record, outputdir, prefix, headers, caption_options)
+
+async def _export_post_files(host, record, outputdir, prefix, headers, caption_options):
+    #A training set wants the original file, not the sample a grab shows. Boorus that hide
+    #a post's original only leave the sample
+    image_url = _absolute_url(host, record.file_url or record.image_url)
+    original = bool(record.file_url) or record.original
+    if not image_url:
+        raise ValueError("the post has no image URL")
+
+    _, ext = os.path.splitext(parse.urlparse(image_url).path)
+    if not ext or len(ext) > 6:
+        ext = ".jpg"
+    stem = os.path.join(outputdir, f"{prefix}_{record.id}")
+
+    #Download beside the final name first, so an interrupted download never looks finished
+    partial_path = f"{stem}{ext}.part"
+    await _download_image(image_url, partial_path, headers=headers, md5=record.md5, original=original, post=(host, record.id))
+    os.replace(partial_path, stem + ext)
+
+    caption = _assemble_tags(record.to_dict(), *caption_options)
+    with _span("write caption", "file", path=stem + ".txt"), open(stem + ".txt", "w", encoding="utf-8") as file:
+        file.write(caption)
+
+_warmup_future = None
+
+def _start_warmup(settings):
+    """Start warming up every configured booru in the background, unless settings.json turns it off."""
+    global _warmup_future
+    if not settings.get("warmup", True):
+        return
+    #The UI can be rebuilt while a warm-up is still going, and one at a time is plenty
+    if _warmup_future is not None and not _warmup_future.done():
+        return
+    _warmup_future = _submit_to_network_loop(_warm_up(settings))
+
+async def _warm_up(settings):
+    """Get every booru ready for its first request, then prefetch the startup search if there is one.
+
+    Connecting resolves the host and completes the TLS handshake, leaving a pooled connection
+    behind for the first real request. Boorus set to detect their type are detected now, unless
+    an earlier session already did. Failures are only logged; a later search will just pay for them.
+    """
+    await asyncio.gather(*(_warm_up_booru(booru) for booru in settings.boorus))
+
+    query = (settings.get("warmupquery") or "").strip()
+    if not query or not settings.active:
+        return
+    #Matches a search from a freshly loaded Search tab, so the first one is answered from what's fetched here
+    _priming.set(True)
+    try:
+        await _search_records(_booru_context(settings.active), _build_tag_query(query), 1, SEARCH_PAGE_SIZE, _compile_result_filter("", True))
+    except Exception as error:
+        print(f"Failed to prefetch \"{query}\" from {settings.active}: {error}")
+
+async def _warm_up_booru(booru):
+    hosts = [host for host in _booru_hosts(booru) if host]
+    connected = await asyncio.gather(*(_warm_up_host(host, mirrored=len(hosts) > 1) for host in hosts))
+    if not any(connected):
+        return
+    try:
+        await _resolve_booru_type(_booru_context(booru["name"]))
+    except Exception as error:
+        print(f"Failed to detect the booru type of {hosts[0]}: {error}")
+
+async def _warm_up_host(host, *, mirrored):
+    started = time.monotonic()
+    try:
+        await _get_http_client().head(host)
+    except httpx.HTTPError as error:
+        print(f"Failed to connect to {host}: {error}")
+        if mirrored:
+            _host_health_for(host).record(time.monotonic() - started, True)
+        return False
+    if mirrored:
+        #Gives mirror selection a first latency to go on before any real request
+        _host_health_for(host).record(time.monotonic() - started, False)
+    return True
+
+class _TagFrequencies:
+    """Running counts of how many posts carry each tag, per category.
+
+    Posts are counted a page at a time with a single bincount and then dropped, so
+    memory only grows with the number of distinct tags, not the number of posts.
+    """
+
+    __slots__ = ("posts", "counts", "ids", "columns")
+
+    def __init__(self):
+        self.posts = 0
+        #One row per POST_TAG_CATEGORIES entry, one column per distinct tag seen so far
+        self.counts = np.zeros((len(POST_TAG_CATEGORIES), 0), dtype=np.int64)
+        #The _tag_table id of each column, and the column of each id. The table is shared by the
+        #whole process, so sizing columns by it would make every run pay for every tag ever seen
+        self.ids = []
+        self.columns = {}
+
+    def add(self, records):
+        if not records:
+            return
+        categories = len(POST_TAG_CATEGORIES)
+        tags = [np.frombuffer(record.tags, dtype=np.uintc) for record in records]
+        sizes = np.concatenate([post_tags[:categories] for post_tags in tags])
+        rows = np.repeat(np.tile(np.arange(categories), len(tags)), sizes)
+        page_ids, positions = np.unique(np.concatenate([post_tags[categories:] for post_tags in tags]), return_inverse=True)
+        page_columns = np.fromiter((self._column(tag_id) for tag_id in page_ids.tolist()), dtype=np.intp, count=len(page_ids))
+        width = len(self.ids)
+        counted = np.bincount(rows * width + page_columns[positions], minlength=categories * width).reshape(categories, width)
+
+        if self.counts.shape[1] < width:
+            self.counts = np.pad(self.counts, ((0, 0), (0, width - self.counts.shape[1])))
+        self.counts[:, :width] += counted
+        self.posts += len(records)
+
+    def _column(self, tag_id):
+        column = self.columns.get(tag_id)
+        if column is None:
+            column = self.columns[tag_id] = len(self.ids)
+            self.ids.append(tag_id)
+        return column
+
+    def top(self, limit, min_frequency, categories=POST_TAG_CATEGORIES):
+        """Return the limit most common tags in categories that are on at least min_frequency of the posts.
+
+        Returns:
+            list: (category, tag, frequency) tuples, most common first
+        """
+        if not self.posts:
+            return []
+        counts = self.counts
+        threshold = max(1, math.ceil(min_frequency * self.posts))
+        wanted = np.isin(np.arange(len(POST_TAG_CATEGORIES)), [POST_TAG_CATEGORIES.index(name) for name in categories])
+        rows, columns = np.nonzero((counts >= threshold) & wanted[:, None])
+        order = np.argsort(-counts[rows, columns], kind="stable")[:limit]
+        names = _tag_table.names(np.asarray(self.ids, dtype=np.int64)[columns[order]])
+        return [
+            (POST_TAG_CATEGORIES[rows[index]], name, counts[rows[index], columns[index]] / self.posts)
+            for index, name in zip(order, names)
+        ]
+
+async def consensusprompt(query, removeanimated, maxposts, topk, minfrequency, replacespaces, replaceunderscores, includeartist, includecharacter, includecopyright, includemeta, booru_name=None, blacklist=""):
+    """Build a prompt from the tags most common across a search's results, instead of from one post.
+
+    Results are counted page by page as they arrive, so the prompt fills in while the
+    search is still being read.
+
+    Args:
+        query (str): A list of tags to search for, delimited by spaces
+        removeanimated (bool): True to skip results with the "animated" tag
+        maxposts (float): How many posts to read
+        topk (float): The most tags to put in the prompt
+        minfrequency (float): The share of posts, from 0 to 1, a tag must be on to be included
+        replacespaces, replaceunderscores, includeartist, includecharacter, includecopyright, includemeta (bool):
+            The tag options from the Select tab, see grabtags
+        booru_name (str, optional): The booru selected in the caller's session. Defaults to the active booru.
+        blacklist (str, optional): Rules for results to skip, see _compile_result_filter. Defaults to "".
+
+    Yields:
+        (str, str): The prompt so far, and how often each of its tags appeared
+    """
+    context = _booru_context(booru_name)
+    tags = _build_tag_query(query)
+    result_filter = _compile_result_filter(blacklist or "", bool(removeanimated))
+    maxposts = max(int(maxposts or 0), 1)
+    caption_options = (replacespaces, replaceunderscores, includeartist, includecharacter, includecopyright, includemeta)
+    frequencies = _TagFrequencies()
+    progress = {"pages": 0}
+
+    future = _submit_to_network_loop(_count_search_tags(context, tags, result_filter, maxposts, frequencies, progress))
+    try:
+        while not future.done():
+            yield _describe_consensus(frequencies, progress, int(topk or 1), float(minfrequency or 0), caption_options)
+            await asyncio.sleep(CONSENSUS_PROGRESS_INTERVAL)
+        future.result()
+    finally:
+        future.cancel()
+
+    prompt, summary = _describe_consensus(frequencies, progress, int(topk or 1), float(minfrequency or 0), caption_options)
+    yield prompt, summary + "\nDone."
+
+def _describe_consensus(frequencies, progress, topk, minfrequency, caption_options):
+    includeartist, includecharacter, includecopyright, includemeta = caption_options[2:]
+    included = {"general": True, "artist": includeartist, "character": includecharacter, "copyright": includecopyright, "meta": includemeta}
+    #Tags the prompt leaves out shouldn't take up any of its places
+    top = frequencies.top(topk, minfrequency, [category for category in POST_TAG_CATEGORIES if included[category]])
+    normalized = {category: [] for category in POST_TAG_CATEGORIES}
+    for category, tag, _ in top:
+        normalized[category].append(tag)
+    prompt = _assemble_tags(normalized, *caption_options)
+
+    lines = [f"Read {frequencies.posts} posts from {progress['pages']} pages."]
+    lines.extend(f"{frequency:6.1%}  {tag} ({category})" for category, tag, frequency in top)
+    return prompt, "\n".join(lines)
+
+@_profiled("consensusprompt")
+async def _count_search_tags(context, tags, result_filter, maxposts, frequencies, progress):
+    booru_type = await _resolve_booru_type(context)
+    handler = SEARCH_HANDLERS.get(booru_type)
+    if handler is None:
+        raise gr.Error(f"Search is not supported for booru type '{booru_type}'.")
+
+    page_size = MAX_PAGE_SIZES.get(booru_type, 100)
+    page = 1
+    while frequencies.posts < maxposts:
+        records = await _search_page(handler, context, booru_type, tags, page, page_size, result_filter)
+        exhausted = len(records) < page_size
+        records = records[:maxposts - frequencies.posts]
+        if booru_type in TAG_TYPE_LOOKUPS:
+            #Moebooru looks tags up one request at a time, far too many for thousands of posts,
+            #so only categories already cached are used, the same as in search results
+            records = await _categorize_records(context["host"], context["username"], context["apikey"], context["cookie"], booru_type, records, lookup=False)
+        with _span("count tags", "parse", posts=len(records)):
+            frequencies.add(records)
+        progress["pages"] = page
+        if exhausted:
+            break
+        page += 1
+
+def _saved_search_label(search):
+    return f"{search['booru']}: {search['query']}"
+
+def _saved_search_labels():
+    return [_saved_search_label(search) for search in _current_settings().get("savedsearches", [])]
+
+def savesearch(query, booru_name=None):
+    """Add a search to the Watch tab, so refreshing it later only shows posts newer than the last refresh.
+
+    Args:
+        query (str): A list of tags to search for, delimited by spaces
+        booru_name (str, optional): The booru selected in the caller's session. Defaults to the active booru.
+
+    Returns:
+        dict: An update for the saved searches dropdown, with the new search selected
+    """
+    context = _booru_context(booru_name)
+    tags = _build_tag_query(query)
+    if not _supports_cursor(tags):
+        raise gr.Error("Saved searches find new posts by id, so they can't use order: or sort:.")
+
+    search = {"booru": context["name"], "query": tags, "seen": None}
+
+    def apply(raw):
+        if not any(saved["booru"] == search["booru"] and saved["query"] == tags for saved in raw["savedsearches"]):
+            raw["savedsearches"].append(search)
+
+    _update_settings(apply)
+    return gr.Dropdown.update(choices=_saved_search_labels(), value=[_saved_search_label(search)])
+
+def removesearches(selected):
+    """Remove the selected saved searches from the Watch tab.
+
+    Args:
+        selected (list of str): Labels of the saved searches to remove
+
+    Returns:
+        dict: An update for the saved searches dropdown
+    """
+    selected = set(selected or [])
+
+    def apply(raw):
+        raw["savedsearches"] = [search for search in raw["savedsearches"] if _saved_search_label(search) not in selected]
+
+    _update_settings(apply)
+    return _saved_searches_update()
+
+def _saved_searches_update():
+    #Also sent after a booru is renamed or removed, which changes the saved searches with it
+    return gr.Dropdown.update(choices=_saved_search_labels(), value=[])
+
+async def refreshsearches(selected, feed, removeanimated, replacespaces, replaceunderscores, includeartist, includecharacter, includecopyright, includemeta, blacklist=""):
+    """Fetch the posts added to saved searches since they were last refreshed, and put a prompt for each into the feed.
+
+    Args:
+        selected (list of str): Labels of the saved searches to refresh. Empty refreshes all of them
+        feed (list): The feed's current rows of (saved search, post, prompt)
+        removeanimated (bool): True to leave results with the "animated" tag out of the feed
+        The tag options match the checkboxes on the Select tab, see grabtags.
+        blacklist (str): Blacklist rules, one per line, for posts to leave out of the feed
+
+    Returns:
+        (list, str): The feed with the new posts on top, and how many each search found
+    """
+    searches = _current_settings().get("savedsearches", [])
+    if selected:
+        searches = [search for search in searches if _saved_search_label(search) in selected]
+    if not searches:
+        raise gr.Error("Save a search first.")
+
+    result_filter = _compile_result_filter(blacklist or "", bool(removeanimated))
+    caption_options = (replacespaces, replaceunderscores, includeartist, includecharacter, includecopyright, includemeta)
+    outcomes = await _run_on_network_loop(_refresh_saved_searches(searches, result_filter))
+
+    rows, lines = [], []
+    for search, outcome in zip(searches, outcomes):
+        label = _saved_search_label(search)
+        if isinstance(outcome, Exception):
+            lines.append(f"{label}: {getattr(outcome, 'message', None) or outcome}")
+            continue
+        lines.append(f"{label}: {len(outcome)} new")
+        rows.extend([label, f"id:{record.id}", _assemble_tags(record.to_dict(), *caption_options)] for record in outcome)
+
+    #An empty Dataframe still comes with one blank row
+    existing = [row for row in (feed or []) if len(row) == 3 and row[1]]
+    return (rows + existing)[:WATCH_FEED_ROWS], "\n".join(lines)
+
+def _feed_post(feed, evt: gr.SelectData):
+    #Whichever cell was clicked, pick up the post of its row
+    return feed[evt.index[0]][1]
+
+async def _refresh_saved_searches(searches, result_filter):
+    """Refresh every search at once. Each search's outcome is its new posts, newest first, or the exception it raised."""
+    async def refresh(search):
+        try:
+            context = _booru_context(search["booru"])
+            newest, records = await _newer_saved_posts(context, search["query"], search.get("seen"), result_filter)
+        except asyncio.CancelledError:
+            raise
+        except Exception as error:
+            return error
+        if newest is not None:
+            _mark_saved_search_seen(search, newest)
+        return records
+
+    return await asyncio.gather(*(refresh(search) for search in searches))
+
+def _mark_saved_search_seen(search, newest):
+    def apply(raw):
+        for saved in raw["savedsearches"]:
+            if saved["booru"] == search["booru"] and saved["query"] == search["query"]:
+                saved["seen"] = max(saved.get("seen") or 0, newest)
+
+    _update_settings(apply)
+
+async def _newer_saved_posts(context, tags, seen, result_filter):
+    """Fetch the posts of one saved search that are newer than the post id seen.
+
+    A search that has never been refreshed reads its newest page instead, to find where to start.
+
+    Returns:
+        (int, list of _PostRecord): The newest post id fetched, or None if nothing was,
+        and the fetched posts that passed the filter, newest first
+    """
+    booru_type = await _resolve_booru_type(context)
+    handler = SEARCH_HANDLERS.get(booru_type)
+    if handler is None:
+        raise gr.Error(f"Search is not supported for booru type '{booru_type}'.")
+
+    host, username, apikey, cookie = context["host"], context["username"], context["apikey"], context["cookie"]
+    args = (host, username, apikey, cookie, tags)
+    if seen is None:
+        fetched = await handler(*args, 1, WATCH_FIRST_REFRESH_POSTS)
+    else:
+        fetched = []
+        batch_size = MAX_PAGE_SIZES.get(booru_type, WATCH_FIRST_REFRESH_POSTS)
+        async for records in _newer_posts(handler, args, booru_type, seen, batch_size):
+            fetched.extend(records)
+            if len(fetched) >= MAX_WATCH_POSTS:
+                if booru_type not in AFTER_CURSOR_ASCENDS:
+                    print(f"More than {MAX_WATCH_POSTS} posts are new on {_sanitize_url(host)} for '{tags}', only the newest were read")
+                break
+
+    _cache_posts(host, fetched)
+
+    records = result_filter.apply(fetched) if result_filter else fetched
+    if booru_type in TAG_TYPE_LOOKUPS:
+        records = await _categorize_records(host, username, apikey, cookie, booru_type, records)
+    records.sort(key=lambda record: int(record.id), reverse=True)
+    return (_highest_id(fetched) if fetched else None), records
+
+async def _newer_posts(handler, args, booru_type, since, batch_size):
+    """Walk the results above the post id since, yielding each batch of newer posts.
+
+    The first request carries an ("after", since) cursor, so when nothing is new a refresh
+    costs one empty response however many posts the query matches. Boorus whose after-cursor
+    returns the posts just above it keep stepping upward; the rest return the newest posts
+    first, so the walk continues downward until it reaches since.
+    """
+    ascends = booru_type in AFTER_CURSOR_ASCENDS
+    cursor = ("after", since)
+    while True:
+        with _span("search", "call", limit=batch_size, cursor=cursor[0], id=cursor[1]):
+            fetched = await handler(*args, 1, batch_size, cursor=cursor)
+        newer = [record for record in fetched if record.id.isdigit() and int(record.id) > since]
+        if newer:
+            yield newer
+        if len(fetched) < batch_size or len(newer) < len(fetched):
+            return
+        cursor = ("after", _highest_id(fetched)) if ascends else ("before", _lowest_id(fetched))
+
+#The JSON API is mounted under this path, and only when the webui is started with --api
+API_PREFIX = "/booru2prompt/v1"
+
+#The most posts one batch prompt request may name
+MAX_API_BATCH_SIZE = 200
+#Requests per second the API sends a booru when the caller doesn't choose, shared with exports to the same host
+API_RATE_LIMIT = 2
+
+class _ApiTagOptions(BaseModel):
+    """How a post's tags become a prompt. The defaults match the checkboxes on the Select tab."""
+
+    replacespaces: bool = True
+    replaceunderscores: bool = False
+    includeartist: bool = True
+    includecharacter: bool = True
+    includecopyright: bool = True
+    includemeta: bool = False
+
+    def caption_options(self):
+        return (self.replacespaces, self.replaceunderscores, self.includeartist, self.includecharacter, self.includecopyright, self.includemeta)
+
+class _ApiSearchRequest(BaseModel):
+    query: str = ""
+    page: int = Field(1, ge=1)
+    limit: int = Field(SEARCH_PAGE_SIZE, ge=1)
+    booru: Optional[str] = None
+    removeanimated: bool = True
+    blacklist: str = ""
+
+class _ApiPromptRequest(_ApiTagOptions):
+    post: str
+    booru: Optional[str] = None
+
+class _ApiWatchRequest(_ApiTagOptions):
+    searches: List[str] = []
+    removeanimated: bool = True
+    blacklist: str = ""
+
+class _ApiBatchPromptRequest(_ApiTagOptions):
+    posts: List[str]
+    booru: Optional[str] = None
+    concurrency: int = Field(4, ge=1, le=16)
+    ratelimit: float = Field(API_RATE_LIMIT, ge=0)
+
+def _api_post(host, record):
+    """The JSON shape of a post in API responses."""
+    return {
+        "id": record.id,
+        "image_url": _absolute_url(host, record.image_url),
+        "preview_url": _absolute_url(host, record.preview_url),
+        "md5": record.md5,
+        "rating": record.rating,
+        "ext": record.ext,
+        "tags": {name: record.category(name) for name in POST_TAG_CATEGORIES},
+    }
+
+def _api_prompt(host, record, options):
+    return {
+        "post": _api_post(host, record),
+        "prompt": _assemble_tags(record.to_dict(), *options.caption_options()),
+        "negative_prompt": _current_settings().negativeprompt,
+    }
+
+def _api_error(error):
+    """Turn the gr.Error a handler raised for the UI into a 400 response."""
+    return HTTPException(status_code=400, detail=getattr(error, "message", None) or str(error))
+
+async def _api_search(body: _ApiSearchRequest):
+    """Search the booru and return one page of posts, without downloading any images."""
+    try:
+        context = _booru_context(body.booru)
+        result_filter = _compile_result_filter(body.blacklist, body.removeanimated)
+
+        async def search():
+            booru_type = await _resolve_booru_type(context)
+            limit = min(body.limit, MAX_PAGE_SIZES.get(booru_type, SEARCH_PAGE_SIZE))
+            await _host_rate_limiter(context["host"]).acquire(API_RATE_LIMIT)
+            return await _search_records(context, _build_tag_query(body.query), body.page, limit, result_filter)
+
+        _, records = await _run_on_network_loop(search())
+    except gr.Error as error:
+        raise _api_error(error)
+
+    return {"page": body.page, "posts": [_api_post(context["host"], record) for record in records]}
+
+async def _api_prompt_for_post(body: _ApiPromptRequest):
+    """Build the prompt for one post, given a link to it or an "id:xxxxxx" reference."""
+    try:
+        context = _booru_context(body.booru)
+        post_id, reference_url = _extract_post_id(body.post, context["hosts"])
+
+        async def fetch():
+            #Cached posts cost the booru nothing, so only misses wait on its rate limit
+            if not (post_id and await _cached_post(context["host"], post_id)):
+                await _host_rate_limiter(context["host"]).acquire(API_RATE_LIMIT)
+            return await _fetch_post(context, post_id, reference_url)
+
+        _, record = await _run_on_network_loop(fetch())
+    except gr.Error as error:
+        raise _api_error(error)
+
+    return _api_prompt(context["host"], record, body)
+
+async def _api_prompts_for_posts(body: _ApiBatchPromptRequest):
+    """Build prompts for many posts at once. A post that fails gets an error instead of failing the batch."""
+    if len(body.posts) > MAX_API_BATCH_SIZE:
+        raise HTTPException(status_code=400, detail=f"A batch can hold at most {MAX_API_BATCH_SIZE} posts.")
+    try:
+        context = _booru_context(body.booru)
+    except gr.Error as error:
+        raise _api_error(error)
+
+    async def prompt_all():
+        limiter = _host_rate_limiter(context["host"])
+        slots = asyncio.Semaphore(body.concurrency)
+
+        async def prompt_one(reference):
+            try:
+                post_id, reference_url = _extract_post_id(reference, context["hosts"])
+                async with slots:
+                    if not (post_id and await _cached_post(context["host"], post_id)):
+                        await limiter.acquire(body.ratelimit)
+                    _, record = await _fetch_post(context, post_id, reference_url)
+            except asyncio.CancelledError:
+                raise
+            except Exception as error:
+                return {"reference": reference, "error": getattr(error, "message", None) or str(error) or type(error).__name__}
+            return {"reference": reference, **_api_prompt(context["host"], record, body)}
+
+        return await asyncio.gather(*(prompt_one(reference) for reference in body.posts))
+
+    return {"results": await _run_on_network_loop(prompt_all())}
+
+async def _api_refresh_saved_searches(body: _ApiWatchRequest):
+    """Return the posts added to saved searches since they were last refreshed, with a prompt for each.
+
+    Name searches as "Booru: query", the way the Watch tab lists them. No names refreshes every saved search.
+    """
+    searches = _current_settings().get("savedsearches", [])
+    if body.searches:
+        searches = [search for search in searches if _saved_search_label(search) in body.searches]
+
+    result_filter = _compile_result_filter(body.blacklist, body.removeanimated)
+    outcomes = await _run_on_network_loop(_refresh_saved_searches(searches, result_filter))
+
+    results = []
+    for search, outcome in zip(searches, outcomes):
+        result = {"search": _saved_search_label(search)}
+        if isinstance(outcome, Exception):
+            result["error"] = getattr(outcome, "message", None) or str(outcome) or type(outcome).__name__
+        else:
+            host = _booru_context(search["booru"])["host"]
+            result["posts"] = [_api_prompt(host, record, body) for record in outcome]
+        results.append(result)
+    return {"results": results}
+
+def _api_auth_dependencies():
+    """Require the webui's --api-auth credentials, if it has any, just like its own API does."""
+    credentials = {}
+    for pair in (getattr(shared.cmd_opts, "api_auth", None) or "").split(","):
+        if ":" in pair:
+            user, password = pair.strip().split(":", 1)
+            credentials[user] = password
+    if not credentials:
+        return []
+
+    def authenticate(supplied: HTTPBasicCredentials = Depends(HTTPBasic())):
+        expected = credentials.get(supplied.username)
+        if expected is None or not hmac.compare_digest(supplied.password, expected):
+            raise HTTPException(status_code=401, detail="Incorrect username or password", headers={"WWW-Authenticate": "Basic"})
+
+    return [Depends(authenticate)]
+
+def on_app_started(demo, app):
+    """Mount the image proxy the Search tab relies on, and the JSON API next to the webui's own when it's serving one."""
+    app.add_api_route(IMAGE_PROXY_PATH, _proxy_image, methods=["GET"], include_in_schema=False)
+
+    if not (getattr(shared.cmd_opts, "api", False) or getattr(shared.cmd_opts, "nowebui", False)):
+        return
+
+    dependencies = _api_auth_dependencies()
+    app.add_api_route(f"{API_PREFIX}/search", _api_search, methods=["POST"], dependencies=dependencies)
+    app.add_api_route(f"{API_PREFIX}/prompt", _api_prompt_for_post, methods=["POST"], dependencies=dependencies)
+    app.add_api_route(f"{API_PREFIX}/prompts", _api_prompts_for_posts, methods=["POST"], dependencies=dependencies)
+    app.add_api_route(f"{API_PREFIX}/watch", _api_refresh_saved_searches, methods=["POST"], dependencies=dependencies)
 
 def on_ui_tabs():
     #Just setting up some gradio components way early
@@ -1061,16 +3843,17 @@ def on_ui_tabs():
     #However, for these ones, I need to reference them before they would've otherwise been
     #initialized, so I put them up here instead. This is totally fine, since they can be 
     #rendered in the appropirate place with .render()
-    _ensure_active()
-    boorulist = _booru_names()
-    active_booru = next((b for b in settings["boorus"] if b["name"] == settings["active"]), {})
+    settings = _current_settings()
+    _start_warmup(settings)
+    boorulist = [booru["name"] for booru in settings.boorus]
+    active_booru = settings.by_name.get(settings.active, {})
     active_system_display = SYSTEM_DISPLAY_NAMES.get(active_booru.get("system", "auto"), SYSTEM_DISPLAY_NAMES["auto"])
     selectimage = gr.Image(label="Image", type="filepath", interactive=False)
-    searchimages = gr.Gallery(label="Search Results", columns=3)
-    activeboorutext1 = gr.Textbox(label="Current Booru", value=settings['active'], interactive=False)
-    activeboorutext2 = gr.Textbox(label="Current Booru", value=settings['active'], interactive=False)
+    searchimages = _RemoteGallery(label="Search Results", columns=3)
+    activeboorutext1 = gr.Textbox(label="Current Booru", value=settings.active, interactive=False)
+    activeboorutext2 = gr.Textbox(label="Current Booru", value=settings.active, interactive=False)
     curpage = gr.Textbox(value="1", label="Page Number", interactive=False, show_label=True)
-    negprompt = gr.Textbox(label="Negative Prompt", value=settings['negativeprompt'], placeholder="Negative prompt to send with along with each prompt")
+    negprompt = gr.Textbox(label="Negative Prompt", value=settings.negativeprompt, placeholder="Negative prompt to send with along with each prompt")
 
     with gr.Blocks() as interface:
         with gr.Tab("Select"):
@@ -1099,23 +3882,28 @@ def on_ui_tabs():
                     replaceunderscores = gr.Checkbox(value=False, label="Replace underscores with spaces")
 
                     selectbutton = gr.Button(value="Select Image", variant="primary")
-                    selectbutton.click(fn=grabtags,
-                        inputs=
-                            [imagelink, 
+                    grabtagsinputs = [imagelink, 
                             negprompt,
                             replacespaces, 
                             replaceunderscores,
                             includeartist, 
                             includecharacter, 
                             includecopyright, 
-                            includemeta], 
-                        outputs=
-                            [selectedtags, 
+                            includemeta,
+                            activeboorutext1]
+                    grabtagsoutputs = [selectedtags, 
                             selectimage, 
                             selectedtags_artist, 
                             selectedtags_character, 
                             selectedtags_copyright, 
-                            selectedtags_meta])
+                            selectedtags_meta]
+                    selectbutton.click(fn=grabtags, inputs=grabtagsinputs, outputs=grabtagsoutputs)
+
+                    with gr.Accordion("Find post from image", open=False):
+                        findimage = gr.Image(label="Image to look up", type="filepath")
+                        findbutton = gr.Button(value="Find Post")
+                        #Finding the post fills in the link box, then it's selected like any other link
+                        findbutton.click(fn=findpost, inputs=[findimage, activeboorutext1], outputs=imagelink).success(fn=grabtags, inputs=grabtagsinputs, outputs=grabtagsoutputs)
 
                     clearselected = gr.Button(value="Clear")
                     #This is just a cheeky way to clear out all the components in this tab. I'm sure this is not what you're meant to use lambda functions for.
@@ -1133,17 +3921,22 @@ def on_ui_tabs():
                     activeboorutext2.render()
                     searchtext = gr.Textbox(label="Search string", placeholder="List of tags, delimited by spaces")
                     removeanimated = gr.Checkbox(label="Remove results with the \"animated\" tag", value=True)
+                    blacklist = gr.Textbox(label="Blacklist", lines=2, placeholder="One rule per line, e.g. \"comic\", \"rating:e\", \"ext:gif\" or \"tag_a -tag_b\"")
                     searchbutton = gr.Button(value="Search Booru", variant="primary")
-                    searchtext.submit(fn=searchbooru, inputs=[searchtext, removeanimated, curpage], outputs=[searchimages, curpage])
-                    searchbutton.click(fn=searchbooru, inputs=[searchtext, removeanimated, curpage], outputs=[searchimages, curpage])
+                    searchtext.submit(fn=searchbooru, inputs=[searchtext, removeanimated, curpage, activeboorutext2, blacklist], outputs=[searchimages, curpage])
+                    searchbutton.click(fn=searchbooru, inputs=[searchtext, removeanimated, curpage, activeboorutext2, blacklist], outputs=[searchimages, curpage])
                 with gr.Column():
                     with gr.Row():
                         prevpage = gr.Button(value="Previous Page")
                         curpage.render()
                         nextpage = gr.Button(value="Next Page")
                         #The functions called here will then call searchbooru, just with a page in/decrement modifier
-                        prevpage.click(fn=gotoprevpage, inputs=[searchtext, removeanimated, curpage], outputs=[searchimages, curpage])
-                        nextpage.click(fn=gotonextpage, inputs=[searchtext, removeanimated, curpage], outputs=[searchimages, curpage])
+                        prevpage.click(fn=gotoprevpage, inputs=[searchtext, removeanimated, curpage, activeboorutext2, blacklist], outputs=[searchimages, curpage])
+                        nextpage.click(fn=gotonextpage, inputs=[searchtext, removeanimated, curpage, activeboorutext2, blacklist], outputs=[searchimages, curpage])
+                    with gr.Row():
+                        jumppage = gr.Number(label="Jump to page", value=1, precision=0)
+                        jumpbutton = gr.Button(value="Go to Page")
+                        jumpbutton.click(fn=gotopage, inputs=[searchtext, removeanimated, jumppage, activeboorutext2, blacklist], outputs=[searchimages, curpage])
                     searchimages.render()
                     with gr.Row():
                         sendsearched = gr.Button(value="Send image to tag selection", elem_id="sendselected")
@@ -1151,12 +3944,111 @@ def on_ui_tabs():
                         #gallery, and send it back here to the imagelink output. I cannot fathom why Gradio galleries can't
                         #be used as inputs, but so be it.
                         sendsearched.click(fn = None, _js="switch_to_select", outputs = imagelink)
+        with gr.Tab("Consensus"):
+            with gr.Row(equal_height=True):
+                with gr.Column():
+                    consensushelptext = gr.HTML(value="Read many results of a search and build a prompt from the tags they have most in common. Tags use the options from the Select tab, and the Search tab's blacklist applies.")
+                    consensustext = gr.Textbox(label="Search string", placeholder="List of tags, delimited by spaces")
+                    consensusremoveanimated = gr.Checkbox(label="Remove results with the \"animated\" tag", value=True)
+                    with gr.Row():
+                        consensusmax = gr.Number(label="Posts to read", value=1000, precision=0)
+                        consensustopk = gr.Slider(label="Most tags in the prompt", minimum=1, maximum=100, step=1, value=30)
+                        consensusfrequency = gr.Slider(label="Share of posts a tag must be on", minimum=0, maximum=1, step=0.05, value=0.2)
+                    with gr.Row():
+                        consensusbutton = gr.Button(value="Build Prompt", variant="primary")
+                        stopconsensusbutton = gr.Button(value="Stop")
+                with gr.Column():
+                    consensusprompttext = gr.Textbox(label="Consensus Prompt", interactive=False, lines=3)
+                    with gr.Row(equal_height=True):
+                        sendconsensus = modules.infotext_utils.create_buttons(["txt2img", "img2img"])
+                        modules.infotext_utils.bind_buttons(sendconsensus, None, consensusprompttext)
+                    consensussummary = gr.Textbox(label="Tag Frequencies", interactive=False, lines=12)
+            consensusevent = consensusbutton.click(fn=consensusprompt,
+                inputs=
+                    [consensustext,
+                    consensusremoveanimated,
+                    consensusmax,
+                    consensustopk,
+                    consensusfrequency,
+                    replacespaces,
+                    replaceunderscores,
+                    includeartist,
+                    includecharacter,
+                    includecopyright,
+                    includemeta,
+                    activeboorutext2,
+                    blacklist],
+                outputs=[consensusprompttext, consensussummary])
+            stopconsensusbutton.click(fn=None, cancels=[consensusevent])
+        with gr.Tab("Watch"):
+            with gr.Row(equal_height=True):
+                with gr.Column():
+                    watchhelptext = gr.HTML(value="Save the searches you check often, then refresh them to see only the posts added since the last refresh. Tags use the options from the Select tab, and the Search tab's blacklist applies. Click a row in the feed to put its post in the Select tab's link box.")
+                    watchtext = gr.Textbox(label="Search string", placeholder="List of tags, delimited by spaces")
+                    savesearchbutton = gr.Button(value="Save Search")
+                    savedsearches = gr.Dropdown(label="Saved searches (none selected refreshes all)", choices=_saved_search_labels(), value=[], multiselect=True, interactive=True)
+                    with gr.Row():
+                        refreshbutton = gr.Button(value="Refresh", variant="primary")
+                        removesearchbutton = gr.Button(value="Remove Selected")
+                    watchstatus = gr.Textbox(label="Last Refresh", interactive=False, lines=3)
+                with gr.Column():
+                    watchfeed = gr.Dataframe(label="New Posts", headers=["Saved search", "Post", "Prompt"], datatype=["str", "str", "str"], type="array", interactive=False, wrap=True)
+            savesearchbutton.click(fn=savesearch, inputs=[watchtext, activeboorutext2], outputs=savedsearches)
+            removesearchbutton.click(fn=removesearches, inputs=savedsearches, outputs=savedsearches)
+            refreshbutton.click(fn=refreshsearches,
+                inputs=
+                    [savedsearches,
+                    watchfeed,
+                    removeanimated,
+                    replacespaces,
+                    replaceunderscores,
+                    includeartist,
+                    includecharacter,
+                    includecopyright,
+                    includemeta,
+                    blacklist],
+                outputs=[watchfeed, watchstatus])
+            watchfeed.select(fn=_feed_post, inputs=watchfeed, outputs=imagelink)
+        with gr.Tab("Export"):
+            with gr.Row(equal_height=True):
+                with gr.Column():
+                    exporthelptext = gr.HTML(value="Download every result of a search along with a .txt caption for each image. Captions use the tag options from the Select tab, and the Search tab's blacklist applies. Running an export again in the same folder resumes it.")
+                    exporttext = gr.Textbox(label="Search string", placeholder="List of tags, delimited by spaces")
+                    exportremoveanimated = gr.Checkbox(label="Remove results with the \"animated\" tag", value=True)
+                    exportdir = gr.Textbox(label="Output folder", placeholder="/path/to/dataset")
+                    with gr.Row():
+                        exportmax = gr.Number(label="Maximum posts (0 for all)", value=0, precision=0)
+                        exportconcurrency = gr.Slider(label="Parallel downloads", minimum=1, maximum=16, step=1, value=4)
+                        exportrate = gr.Number(label="Requests per second (0 for no limit)", value=2)
+                    with gr.Row():
+                        exportbutton = gr.Button(value="Start Export", variant="primary")
+                        stopexportbutton = gr.Button(value="Stop Export")
+                with gr.Column():
+                    exportstatus = gr.Textbox(label="Export Progress", interactive=False, lines=4)
+            exportevent = exportbutton.click(fn=exportdataset,
+                inputs=
+                    [exporttext,
+                    exportremoveanimated,
+                    exportdir,
+                    exportmax,
+                    exportconcurrency,
+                    exportrate,
+                    replacespaces,
+                    replaceunderscores,
+                    includeartist,
+                    includecharacter,
+                    includecopyright,
+                    includemeta,
+                    activeboorutext2,
+                    blacklist],
+                outputs=exportstatus)
+            stopexportbutton.click(fn=None, cancels=[exportevent])
         with gr.Tab("Settings/API Keys"):
             settingshelptext = gr.HTML(interactive=False, show_label = False, value="API info may not be necessary for some boorus, but certain information or posts may fail to load without it. For example, Danbooru doesn't show certain posts in search results unless you auth as a Gold tier member.")
             settingshelptext2 = gr.HTML(interactive=False, show_label=False, value="Also, please set the booru selection here before using select or search. If the booru presents a browser challenge, paste the validated session cookie below.")
-            booru = gr.Dropdown(label="Booru", value=settings['active'], choices=boorulist, interactive=True)
-            booruname = gr.Textbox(label="Booru Name", value=active_booru.get("name", settings.get("active", "")), placeholder="Display name shown in menus")
-            booruhost = gr.Textbox(label="Booru Host URL", value=active_booru.get("host", ""), placeholder="https://example.com")
+            booru = gr.Dropdown(label="Booru", value=settings.active, choices=boorulist, interactive=True)
+            booruname = gr.Textbox(label="Booru Name", value=active_booru.get("name", settings.active), placeholder="Display name shown in menus")
+            booruhost = gr.Textbox(label="Booru Host URL", value=_format_hosts(active_booru), placeholder="https://example.com, or several hosts serving the same booru separated by commas")
             u, a = getauth()
             username = gr.Textbox(label="Username", value=u)
             apikey = gr.Textbox(label="API Key", value=a)
@@ -1167,11 +4059,12 @@ def on_ui_tabs():
                 addboorubutton = gr.Button(value="Add as New Booru", variant="secondary")
                 savesettingsbutton = gr.Button(value="Save Booru", variant="primary")
                 removeboorubutton = gr.Button(value="Remove Booru", variant="secondary")
-            savesettingsbutton.click(fn=savesettings, inputs=[booru, booruname, booruhost, username, apikey, cookie, boorutype, negprompt], outputs=[booru, booruname, booruhost, username, apikey, cookie, boorutype, activeboorutext1, activeboorutext2])
+            savesettingsbutton.click(fn=savesettings, inputs=[booru, booruname, booruhost, username, apikey, cookie, boorutype, negprompt], outputs=[booru, booruname, booruhost, username, apikey, cookie, boorutype, activeboorutext1, activeboorutext2]).then(fn=_saved_searches_update, outputs=savedsearches)
             addboorubutton.click(fn=addbooru, inputs=[booruname, booruhost, username, apikey, cookie, boorutype, negprompt], outputs=[booru, booruname, booruhost, username, apikey, cookie, boorutype, activeboorutext1, activeboorutext2])
-            removeboorubutton.click(fn=removebooru, inputs=[booru, negprompt], outputs=[booru, booruname, booruhost, username, apikey, cookie, boorutype, activeboorutext1, activeboorutext2])
+            removeboorubutton.click(fn=removebooru, inputs=[booru, negprompt], outputs=[booru, booruname, booruhost, username, apikey, cookie, boorutype, activeboorutext1, activeboorutext2]).then(fn=_saved_searches_update, outputs=savedsearches)
             booru.change(fn=updatesettings, inputs=booru, outputs=[username, apikey, cookie, activeboorutext1, activeboorutext2, booruname, booruhost, boorutype])
 
     return (interface, "booru2prompt", "b2p_interface"),
 
 script_callbacks.on_ui_tabs(on_ui_tabs)
+script_callbacks.on_app_started(on_app_started)